@@ -0,0 +1,56 @@
+"""
+Per-event cost of rendering a message as a mail, for each format of the
+embedded event source, through EmailMessage and through render_event(),
+which takes the fast path where it can.
+
+    python benchmarks/bench_render.py [--number N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from nio import MatrixRoom, RoomMessageText
+
+from mxmda.mail import event_to_email, flatten, orjson, render_event, \
+                       source_formats
+
+def message(body):
+    return RoomMessageText.from_dict({
+        'type': 'm.room.message',
+        'event_id': '$Rqnc-F-dvnEYJTyHq_iKxU2bZ1CI92-kuZq3a5lr5Zg',
+        'sender': '@someone:example.org',
+        'origin_server_ts': 1700000000000,
+        'content': {'msgtype': 'm.text', 'body': body},
+        'unsigned': {'age': 1234, 'transaction_id': 'm1700000000000.0'},
+    })
+
+def main(args):
+    room = MatrixRoom('!room:example.org', '@mxmda:example.org')
+    events = {
+        'short': message("Lunch at noon?"),
+        'long': message("\n".join(["A line of a longer message."] * 40)),
+    }
+    print("json is written by %s" % ('orjson' if orjson else 'json'))
+    for name, event in events.items():
+        for source_format in sorted(source_formats):
+            for renderer, render in (
+                ('EmailMessage', lambda: flatten(event_to_email(
+                    room, event, source_format
+                ))),
+                ('render_event', lambda: render_event(
+                    room, event, source_format
+                )),
+            ):
+                seconds = timeit.timeit(render, number=args.number)
+                print("%-6s %-5s %-13s %8.1f us per event" % (
+                    name, source_format, renderer,
+                    seconds / args.number * 1e6
+                ))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--number', type=int, default=2000)
+    main(argparser.parse_args())
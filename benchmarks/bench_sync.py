@@ -0,0 +1,128 @@
+"""
+Payload bytes per sync iteration of the service loop, against a fake
+homeserver on localhost, with and without --full-state.
+
+    python benchmarks/bench_sync.py [--rooms N] [--members N] [--iterations N]
+
+The fake homeserver has rooms with some state each, and one new message
+per room on every sync. It sends the state of every room for a sync
+without a since token, or with full_state, the way a homeserver does.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mxmda.matrix
+
+from mxmda.matrix import SyncResponse
+
+def state(room, members):
+    events = [
+        {'type': 'm.room.create', 'state_key': '', 'content': {'creator': '@admin:example.org'}},
+        {'type': 'm.room.name', 'state_key': '', 'content': {'name': 'Room %d' % room}},
+    ]
+    events.extend({
+        'type': 'm.room.member',
+        'state_key': '@user%d:example.org' % n,
+        'content': {'membership': 'join', 'displayname': 'User %d' % n},
+    } for n in range(members))
+    for n, event in enumerate(events):
+        event.update(event_id='$state%d-%d' % (room, n),
+                     sender='@admin:example.org',
+                     origin_server_ts=1700000000000)
+    return events
+
+class FakeHomeserver:
+    def __init__(self, rooms, members):
+        self.rooms = rooms
+        self.members = members
+        self.batch = 0
+        self.sent = 0
+
+    async def sync(self, request):
+        full = 'since' not in request.query or \
+               request.query.get('full_state') == 'true'
+        self.batch += 1
+        body = {'next_batch': 's%d' % self.batch, 'rooms': {'join': {
+            '!room%d:example.org' % room: {
+                'state': {'events': state(room, self.members) if full else []},
+                'timeline': {'limited': False, 'prev_batch': 'p', 'events': [{
+                    'type': 'm.room.message',
+                    'event_id': '$msg%d-%d' % (room, self.batch),
+                    'sender': '@user0:example.org',
+                    'origin_server_ts': 1700000000000 + self.batch,
+                    'content': {'msgtype': 'm.text', 'body': 'Hello'},
+                }]},
+            } for room in range(self.rooms)
+        }}}
+        resp = web.json_response(body)
+        self.sent += len(resp.body)
+        return resp
+
+class App:
+    logger = logging.getLogger('bench')
+
+    def update_device(self, **items):
+        pass
+
+async def measure(server, port, nio_dir, full_state, iterations):
+    app = App()
+    app.client = client = mxmda.matrix.Client(
+        app=app,
+        config={'user': '@mxmda:example.org', 'sync_filter': False,
+                'homeserver': 'http://127.0.0.1:%d' % port},
+        nio_dir=nio_dir,
+        device={'access_token': 'token', 'device_id': 'DEVICE',
+                'user_id': '@mxmda:example.org'},
+        log_level=logging.WARNING,
+        timeout=0,
+        full_state=full_state,
+    )
+    syncs = 0
+
+    async def count(response):
+        nonlocal syncs
+        syncs += 1
+        if syncs == iterations:
+            client.stop()
+
+    # The initial sync, which is a full one either way.
+    await client.sync(timeout=0)
+    server.sent = 0
+    client.add_response_callback(count, SyncResponse)
+    await client.enter_loop()
+    return server.sent / iterations
+
+async def main(args):
+    server = FakeHomeserver(args.rooms, args.members)
+    app = web.Application()
+    app.router.add_get('/_matrix/client/v3/sync', server.sync)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for full_state in (True, False):
+                per_sync = await measure(server, port, tmp, full_state,
+                                         args.iterations)
+                print("%-12s %10.0f bytes per sync" % (
+                    'full_state' if full_state else 'incremental', per_sync
+                ))
+    finally:
+        await runner.cleanup()
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--rooms', type=int, default=200)
+    argparser.add_argument('--members', type=int, default=50)
+    argparser.add_argument('--iterations', type=int, default=10)
+    asyncio.run(main(argparser.parse_args()))
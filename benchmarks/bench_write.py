@@ -0,0 +1,68 @@
+"""
+Time and peak memory of writing a large mail to a maildir, the old way,
+through str(mail) and a text mode file, and the current way, with
+BytesGenerator straight into a binary file.
+
+    python benchmarks/bench_write.py [--size BYTES] [--number N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from nio import MatrixRoom, RoomMessageText
+
+from mxmda.mail import event_to_email
+from mxmda.maildir import Maildir
+
+def message(size):
+    line = "A line of a rather large message, with a YAML source. "
+    body = "\n".join([line] * (size // 2 // len(line)))
+    return RoomMessageText.from_dict({
+        'type': 'm.room.message',
+        'event_id': '$event',
+        'sender': '@someone:example.org',
+        'origin_server_ts': 1700000000000,
+        'content': {'msgtype': 'm.text', 'body': body},
+    })
+
+def write_str(maildir, mail):
+    # How mails were written before: print(mail, file=fh).
+    filename = os.path.join(maildir.path, 'tmp', maildir.unique_name())
+    with open(filename, 'w') as fh:
+        print(mail, file=fh)
+
+def write_bytes(maildir, mail):
+    maildir.stage(mail)
+
+def measure(write, maildir, mail, number):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(number):
+        write(maildir, mail)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / number, peak
+
+def main(args):
+    room = MatrixRoom('!room:example.org', '@mxmda:example.org')
+    mail = event_to_email(room, message(args.size), 'yaml')
+    with tempfile.TemporaryDirectory() as tmp:
+        maildir = Maildir(tmp)
+        for name, write in (('str', write_str),
+                            ('BytesGenerator', write_bytes)):
+            seconds, peak = measure(write, maildir, mail, args.number)
+            print("%-15s %8.2f ms per mail, %8.0f KiB peak" % (
+                name, seconds * 1000, peak / 1024
+            ))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--size', type=int, default=800 * 1024)
+    argparser.add_argument('--number', type=int, default=20)
+    main(argparser.parse_args())
@@ -0,0 +1,52 @@
+from collections import deque
+
+class Batch:
+    __slots__ = ('pending', 'token')
+
+    def __init__(self):
+        self.pending = 0
+        self.token = None
+
+class SyncAcks:
+    """
+    Keeps track of which sync responses have had all of their events
+    delivered. Events are tracked against the batch of the sync response
+    they arrived in; once a response has been handled, its batch is
+    sealed with the response's next_batch token. The token of the newest
+    sealed batch that, along with every batch before it, has no events
+    left pending, is handed to commit().
+
+    Restarting from a committed token thus never skips an event that
+    was not delivered.
+    """
+    def __init__(self, commit):
+        self.commit = commit
+        self.sealed = deque()
+        self.current = Batch()
+
+    def track(self, batch=None):
+        """
+        Count an event as pending, in the current batch or, for events
+        that belong to an earlier sync response, in that one's batch.
+        """
+        if batch is None:
+            batch = self.current
+        batch.pending += 1
+        return batch
+
+    def done(self, batch):
+        batch.pending -= 1
+        self.advance()
+
+    def seal(self, token):
+        self.current.token = token
+        self.sealed.append(self.current)
+        self.current = Batch()
+        self.advance()
+
+    def advance(self):
+        token = None
+        while self.sealed and not self.sealed[0].pending:
+            token = self.sealed.popleft().token
+        if token:
+            self.commit(token)
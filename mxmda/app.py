@@ -1,21 +1,36 @@
 import argparse
+import asyncio
+import json
 import logging
 import os
+import signal
 import sys
 import yaml
 
 from pathlib import Path
+from time import monotonic
 from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
-from email.utils import formatdate
-from email.message import EmailMessage
-from platform import node
-from time import time
-from nio import RoomLeaveResponse, JoinResponse, RoomForgetResponse
+from nio import SyncResponse, Event, MatrixRoom
 
 import mxmda
+import mxmda.control
 import mxmda.matrix
+import mxmda.metrics
 
-from mxmda.utils import existing_dir, XDGPaths
+from mxmda.acks import SyncAcks
+from mxmda.control import ControlServer
+from mxmda.errors import BackfillError, CommandError, UserError
+from mxmda.export import Checkpoint, Export, sinks
+from mxmda.mail import event_source, render_event, source_formats
+from mxmda.journal import Journal
+from mxmda.mailindex import MailIndex
+from mxmda.maildir import Maildir, MaildirWriter
+from mxmda.outbox import Outbox
+from mxmda.pipeline import Pipeline
+from mxmda.receipts import Receipts
+from mxmda.roomcache import RoomCache
+from mxmda.seen import SeenEvents
+from mxmda.utils import XDGPaths, existing_dir, lock_file
 
 def arg_parser(name=None):
     """
@@ -52,6 +67,18 @@ def arg_parser(name=None):
         type=Path,
         help="nio's state dir (created by mxmda) (default: %(default)s)",
     )
+    argparser.add_argument(
+        '-S', '--state-dir',
+        default=xdg.state(),
+        type=Path,
+        help="mxmda's own state dir (created by mxmda) (default: %(default)s)",
+    )
+    argparser.add_argument(
+        '--control-socket',
+        help="Path of the service's control socket, which other commands "
+             "are forwarded to if the service is running "
+             "(default: STATE_DIR/control.sock)",
+    )
     argparser.add_argument(
         '-q', '--quiet',
         action='count',
@@ -88,17 +115,171 @@ def arg_parser(name=None):
         default=xdg.state('mail'),
         help="Maildir path (default: %(default)s)",
     )
+    service.add_argument(
+        '--full-state',
+        action='store_true',
+        help="Request the full state of all rooms on every sync, "
+             "not just when recovering from a failed sync",
+    )
+    service.add_argument(
+        '--no-resume',
+        dest='resume',
+        action='store_false',
+        help="Always start with a full state sync, even when there is a "
+             "stored sync token and cached room state to resume from",
+    )
+    service.add_argument(
+        '--processors',
+        type=int,
+        default=4,
+        help="Number of tasks processing received events (default: %(default)s)",
+    )
+    service.add_argument(
+        '--pipeline-depth',
+        type=int,
+        default=256,
+        help="Number of received events that may wait for processing "
+             "before syncing is held back (default: %(default)s)",
+    )
+    service.add_argument(
+        '--no-journal',
+        dest='journal',
+        action='store_false',
+        help="Don't journal received events before delivering them; the "
+             "sync token then only advances as events are delivered",
+    )
+    service.add_argument(
+        '--dedupe-days',
+        type=int,
+        default=30,
+        help="Remember delivered event ids for this many days, and don't "
+             "deliver them again; 0 disables deduplication "
+             "(default: %(default)s)",
+    )
+    service.add_argument(
+        '--backfill-limit',
+        type=int,
+        default=1000,
+        help="Fetch at most this many missed events per room when a sync "
+             "skips over some; 0 disables backfilling (default: %(default)s)",
+    )
+    service.add_argument(
+        '--backfill-concurrency',
+        type=int,
+        default=4,
+        help="Number of rooms to backfill at the same time "
+             "(default: %(default)s)",
+    )
+    service.add_argument(
+        '--delivery-attempts',
+        type=int,
+        default=5,
+        help="Try to deliver an event this many times, backing off in "
+             "between, before giving up on it and logging it, as a line of "
+             "JSON, to deadletter.jsonl in the state directory "
+             "(default: %(default)s)",
+    )
+    service.add_argument(
+        '--outbox',
+        help="Send the mails dropped in this maildir to the rooms they "
+             "are addressed to",
+    )
+    service.add_argument(
+        '--outbox-senders',
+        type=int,
+        default=4,
+        help="Number of outbox mails to send at the same time "
+             "(default: %(default)s)",
+    )
+    service.add_argument(
+        '--receipt-interval',
+        type=float,
+        default=5,
+        metavar='SECONDS',
+        help="Send read receipts, for the newest delivered message in each "
+             "room, this often (default: %(default)s)",
+    )
+    service.add_argument(
+        '--writers',
+        type=int,
+        default=4,
+        help="Number of maildir writer threads (default: %(default)s)",
+    )
+    service.add_argument(
+        '--queue-depth',
+        type=int,
+        default=64,
+        help="Number of mails that may wait for a maildir writer before "
+             "event processing is held back (default: %(default)s)",
+    )
+    service.add_argument(
+        '--fsync',
+        action='store_true',
+        help="Only consider mails delivered once they are fsynced to disk; "
+             "mails are fsynced in groups, see --fsync-window",
+    )
+    service.add_argument(
+        '--fsync-window',
+        type=float,
+        default=5,
+        metavar='MS',
+        help="With --fsync, collect mails for this many milliseconds "
+             "before fsyncing them together (default: %(default)s)",
+    )
+    service.add_argument(
+        '--fsync-batch',
+        type=int,
+        default=64,
+        metavar='N',
+        help="With --fsync, fsync as soon as this many mails are waiting, "
+             "even if the window has not passed (default: %(default)s)",
+    )
+    service.add_argument(
+        '--source-format',
+        choices=sorted(source_formats),
+        default='json',
+        help="Format of the event source attached to each mail "
+             "(default: %(default)s)",
+    )
+
+    reindex = subparsers.add_parser(
+        "reindex",
+        help="Rebuild the index of delivered mails from the maildir",
+    )
+    reindex.add_argument(
+        '--maildir', '-m',
+        default=xdg.state('mail'),
+        help="Maildir path (default: %(default)s)",
+    )
+    reindex.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes reading mails (default: %(default)s)",
+    )
 
     join = subparsers.add_parser(
         "join",
         help="Instruct the bot to join a specified room",
     )
+    join.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=8,
+        help="Number of rooms to join at the same time (default: %(default)s)",
+    )
     join.add_argument('rooms', nargs='*', help='Join these rooms')
 
     leave = subparsers.add_parser(
         "leave",
         help="Instruct the bot to leave a specified room",
     )
+    leave.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=8,
+        help="Number of rooms to leave at the same time (default: %(default)s)",
+    )
     leave.add_argument('rooms', nargs='*', help='Leave these rooms')
 
     rooms = subparsers.add_parser(
@@ -116,6 +297,73 @@ def arg_parser(name=None):
         action='store_true',
         help="List users joined to each room",
     )
+    rooms.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=8,
+        help="Number of rooms to fetch members of at the same time, with "
+             "--list-users (default: %(default)s)",
+    )
+    rooms.add_argument(
+        '--offline',
+        action='store_true',
+        help="List the rooms as last seen, from the room cache, without "
+             "contacting the service or the homeserver",
+    )
+    rooms.add_argument(
+        '--refresh',
+        action='store_true',
+        help="Start from the room cache and catch up with an incremental "
+             "sync, instead of doing a full state sync",
+    )
+
+    export = subparsers.add_parser(
+        "export",
+        help="Export the history of joined rooms to an mbox or maildir",
+    )
+    export.add_argument(
+        '--room', '-r',
+        dest='rooms',
+        action='append',
+        help="Only export rooms listed in arguments; flag can be repeated"
+    )
+    export.add_argument(
+        '--format',
+        choices=sorted(sinks),
+        default='mbox',
+        help="Write to an mbox file or a maildir (default: %(default)s)",
+    )
+    export.add_argument(
+        '--output', '-o',
+        required=True,
+        help="mbox file or maildir to export to",
+    )
+    export.add_argument(
+        '--checkpoint',
+        help="Where to keep track of the export's progress; an interrupted "
+             "export continues from there (default: OUTPUT.checkpoint)",
+    )
+    export.add_argument(
+        '--concurrency',
+        type=int,
+        default=4,
+        help="Number of rooms to fetch at the same time "
+             "(default: %(default)s)",
+    )
+    export.add_argument(
+        '--prefetch',
+        type=int,
+        default=8,
+        help="Number of fetched pages to hold while earlier ones are "
+             "written (default: %(default)s)",
+    )
+    export.add_argument(
+        '--source-format',
+        choices=sorted(source_formats),
+        default='json',
+        help="Format of the event source attached to each mail "
+             "(default: %(default)s)",
+    )
 
     msg = subparsers.add_parser(
         "msg",
@@ -125,7 +373,31 @@ def arg_parser(name=None):
         '--target', '-t',
         help="Send message to this target (room or user)",
     )
-    msg.add_argument('msg', nargs=1, help='Message to send')
+    msg.add_argument(
+        '--batch', '-b',
+        nargs='?',
+        const='-',
+        metavar='FILE',
+        help="Send every message read from FILE, or stdin if not given, "
+             "instead of a single one",
+    )
+    msg.add_argument(
+        '--delimiter',
+        choices=['line', 'nul', 'json'],
+        default='line',
+        help="How messages are separated in --batch input: one per line, "
+             "NUL terminated, or one JSON object per line with a \"text\" "
+             "and optionally a \"target\" (default: %(default)s)",
+    )
+    msg.add_argument(
+        '--concurrency', '-c',
+        type=int,
+        default=4,
+        help="Number of --batch messages to send at the same time; "
+             "messages to the same target are still sent in order "
+             "(default: %(default)s)",
+    )
+    msg.add_argument('msg', nargs='?', help='Message to send')
 
     return argparser
 
@@ -152,25 +424,43 @@ class Application:
         self.device_file = args.device_file
         self.load_device()
 
-        self.client = mxmda.matrix.Client(
-            app=self,
-            nio_dir=args.nio_dir,
-            config=self.config,
-            device=self.device,
-            log_level=args.log_level,
-        )
+        self.args = args
+        self.control_socket = args.control_socket or \
+            os.path.join(args.state_dir, 'control.sock')
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use; loading nio's store is not for free, and
+        # commands forwarded to the service never need a client.
+        if self._client is None:
+            self._client = mxmda.matrix.Client(
+                app=self,
+                nio_dir=self.args.nio_dir,
+                config=self.config,
+                device=self.device,
+                log_level=self.args.log_level,
+                **self.client_options(self.args)
+            )
+        return self._client
+
+    def client_options(self, args):
+        return {}
 
     def write_device(self, device):
         self.logger.info("Updating device file, device id %s",
                          device.get('device_id'))
-        state = {
-            'access_token': device['access_token'],
-            'device_id': device['device_id'],
-            'user_id': device['user_id'],
-        }
+        self.update_device(
+            access_token=device['access_token'],
+            device_id=device['device_id'],
+            user_id=device['user_id'],
+        )
+
+    def update_device(self, **items):
+        # Updated in place; the client holds on to the same dict.
+        self.device.update(items)
         with open(self.device_file, 'w') as fh:
-            yaml.dump(state, fh)
-        self.state = state
+            yaml.dump(self.device, fh)
 
     def load_device(self, default=None):
         try:
@@ -183,145 +473,716 @@ class Service(Application):
     def __init__(self, args):
         super().__init__(args)
 
-        self.maildir = args.maildir
-        for subdir in ('cur', 'new', 'tmp'):
-            existing_dir(os.path.join(self.maildir, subdir))
+        # Before anything in the state directory, or the maildir, is
+        # touched; two services would trample each other's journal.
+        try:
+            self.lock = lock_file(os.path.join(existing_dir(args.state_dir),
+                                               'lock'))
+        except BlockingIOError:
+            raise UserError("A service is already running with the state "
+                            "directory %s" % args.state_dir)
+
+        self.source_format = args.source_format
+        self.maildir = Maildir(args.maildir)
+        self.writer = MaildirWriter(self.maildir,
+                                    workers=args.writers,
+                                    queue_depth=args.queue_depth,
+                                    fsync_window=args.fsync_window / 1000
+                                                 if args.fsync else None,
+                                    fsync_batch=args.fsync_batch)
 
-        self.client.add_event_callback(write_event_to_maildir(self),
-                                       mxmda.matrix.RoomMessageText)
+        self.started = None
+        self.delivered = False
+        self.receipts = Receipts(self, interval=args.receipt_interval)
+
+        # nio runs event callbacks inline while handling a sync response;
+        # all we do there is queue the event, so that the next sync can
+        # start while the events of the previous one are processed.
+        # Events are processed in order within each room, while
+        # different rooms are processed in parallel.
+        self.handler = mxmda.matrix.msg_callback(self, 'maildir',
+                                                 write_event_to_maildir(self))
+        self.pipeline = Pipeline(self.process,
+                                 workers=args.processors,
+                                 depth=args.pipeline_depth,
+                                 key=lambda room, event, ack: room.room_id,
+                                 logger=self.logger)
+        self.acks = SyncAcks(self.client.commit_sync_token)
+        self.journal = None
+        if args.journal:
+            self.journal = Journal(os.path.join(args.state_dir, 'journal'))
+        self.seen = None
+        if args.dedupe_days > 0:
+            self.seen = SeenEvents(os.path.join(args.state_dir, 'seen.db'),
+                                   max_age=args.dedupe_days * 86400)
+        self.duplicates = mxmda.metrics.counter('events.duplicate')
+        self.delivery_attempts = max(1, args.delivery_attempts)
+        self.delivery_retry = 1
+        self.dead_letters = os.path.join(args.state_dir, 'deadletter.jsonl')
+        self.undeliverable = mxmda.metrics.counter('events.undeliverable')
+        self.index = MailIndex(os.path.join(args.state_dir, 'mailindex.db'))
+
+        self.since = None
+        self.backfill_limit = args.backfill_limit
+        self.backfill_concurrency = args.backfill_concurrency
+        self.backfills = None
+        self.backfill_tasks = set()
+        self.gaps = mxmda.metrics.counter('backfill.gaps')
+        self.backfilled = mxmda.metrics.counter('backfill.events')
+
+        self.event_types = (
+            mxmda.matrix.RoomMessageText,
+            mxmda.matrix.RedactionEvent,
+        )
+        self.client.add_event_callback(self.receive, self.event_types)
+        self.client.add_response_callback(self.synced, SyncResponse)
+        self.control = ControlServer(self, self.control_socket)
+        self.outbox = None
+        if args.outbox:
+            self.outbox = Outbox(self, args.outbox,
+                                 senders=args.outbox_senders)
+
+    def client_options(self, args):
+        return {
+            'full_state': args.full_state,
+            'resume': args.resume,
+            'ack_sync_tokens': True,
+        }
+
+    async def receive(self, room, event, batch=None):
+        # With the journal, an event is safe as soon as the journal has
+        # been flushed, and the sync token can move on right away.
+        # Without it, the sync token waits for the event's delivery.
+        if self.journal:
+            ack = self.journal.append(room.room_id, event.source)
+        else:
+            ack = self.acks.track(batch)
+        await self.pipeline.put(room, event, ack)
+
+    async def process(self, room, event, ack):
+        # Only acknowledged once delivered, or given up on; if we are
+        # stopped before, the event stays in the journal, or the sync
+        # token stays put, and it is delivered again after a restart.
+        # Retries hold up the rest of the room, which keeps its order.
+        delay = self.delivery_retry
+        for attempt in range(1, self.delivery_attempts + 1):
+            try:
+                await self.handler(room, event)
+                break
+            except Exception as exc:
+                if attempt == self.delivery_attempts:
+                    self.logger.exception("Giving up on delivering %s",
+                                          event.event_id)
+                    await self.dead_letter(room, event, exc)
+                    break
+                self.logger.warning("Failed to deliver %s, retrying in "
+                                    "%ss: %s", event.event_id, delay, exc)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        if self.journal:
+            self.journal.ack(ack)
+        else:
+            self.acks.done(ack)
+
+    async def dead_letter(self, room, event, exc):
+        # Set aside, so that one event can't keep the sync token, or the
+        # journal, from moving on.
+        self.undeliverable.inc()
+        line = json.dumps({
+            'room_id': room.room_id,
+            'error': str(exc) or type(exc).__name__,
+            'event': event.source,
+        }) + '\n'
+        await asyncio.get_running_loop().run_in_executor(
+            None, append_line, self.dead_letters, line
+        )
+
+    async def synced(self, response):
+        # A limited timeline only has the latest events of a room; the
+        # ones since the previous sync have to be fetched separately.
+        since, self.since = self.since, response.next_batch
+        if since and self.backfill_limit:
+            for room_id, info in response.rooms.join.items():
+                if info.timeline.limited and info.timeline.prev_batch:
+                    self.start_backfill(room_id, info.timeline.prev_batch,
+                                        since)
+        if self.journal:
+            await self.journal.flush()
+        self.acks.seal(response.next_batch)
+
+    def start_backfill(self, room_id, start, end):
+        # Counted as pending in the current sync response, so that its
+        # token isn't committed before the gap has been filled.
+        hold = self.acks.track()
+        task = asyncio.ensure_future(self.backfill(room_id, start, end, hold))
+        self.backfill_tasks.add(task)
+        task.add_done_callback(self.backfill_tasks.discard)
+
+    async def backfill(self, room_id, start, end, hold):
+        self.gaps.inc()
+        async with self.backfills:
+            events = await self.fetch_gap(room_id, start, end)
+        room = self.client.rooms.get(room_id) or \
+               MatrixRoom(room_id, self.client.user_id)
+        events = [event for event in events
+                  if isinstance(event, self.event_types)]
+        self.logger.info("Backfilling %d events in %s", len(events), room_id)
+        # Events that did make it into the sync response are already in
+        # the pipeline; those are skipped as duplicates. Without the
+        # journal, the events count against the batch of the sync
+        # response with the gap, which thus stays uncommitted until they
+        # have been delivered.
+        for event in events:
+            await self.receive(room, event, hold)
+        self.backfilled.inc(len(events))
+        if self.journal:
+            await self.journal.flush()
+        # Only once the gap is filled, or given up on; if we are stopped
+        # before, the sync token stays uncommitted, for the next run to
+        # fetch the gap again.
+        self.acks.done(hold)
+
+    async def fetch_gap(self, room_id, start, end, attempts=3):
+        for attempt in range(attempts):
+            try:
+                events = await self.client.backfill(room_id, start, end,
+                                                    limit=self.backfill_limit)
+                break
+            except BackfillError as exc:
+                self.logger.warning("%s, retrying in %ss", exc,
+                                    self.client.retry_delay)
+                await asyncio.sleep(self.client.retry_delay)
+        else:
+            self.logger.error("Unable to backfill %s, missed messages are "
+                              "lost", room_id)
+            return []
+        if len(events) >= self.backfill_limit:
+            self.logger.warning("More than %d messages missed in %s, older "
+                                "ones are lost", self.backfill_limit, room_id)
+        return events
+
+    async def replay(self, events):
+        if events:
+            self.logger.info("Replaying %d undelivered events from the "
+                             "journal", len(events))
+        for record_id, room_id, source in events:
+            room = self.client.rooms.get(room_id) or \
+                   MatrixRoom(room_id, self.client.user_id)
+            await self.pipeline.put(room, Event.parse_event(source), record_id)
+
+    def stop(self, signum):
+        self.logger.info("Got %s, shutting down", signal.Signals(signum).name)
+        self.client.stop()
+
+    def log_metrics(self):
+        for name, value in mxmda.metrics.snapshot().items():
+            self.logger.info("Metric %s: %s", name, value)
+
+    def log_first_delivery(self, fut):
+        if self.delivered or fut.cancelled() or fut.exception():
+            return
+        self.delivered = True
+        self.logger.info("First delivery %.3fs after startup",
+                         monotonic() - self.started)
 
     async def start(self):
-        self.logger.debug("Starting client")
-        await self.client.start()
-        #await self.client.msg(self.matrix.room,
-        #                      "i'm online now, awaiting interactions")
-        self.logger.info("Matrix initialization complete, entering sync loop")
-        await self.client.enter_loop()
-
-def mxid_to_email(mxid):
-    if not mxid.startswith(('@', '!', '#')):
-        raise ValueError("Invalid mxid %s" % mxid)
-    return mxid[1:].replace(':', '@', 1)
-
-def msg_id(event_id):
-    # FIXME: example.invalid, we can and should do better.
-    #        how do i access the hs domain? which one? mxmda's hs,
-    #        the room's hs or the originating message hs?
-    return f'<{event_id}@example.invalid>'
-
-def event_to_email(room, event):
-    text = event.body.strip()
-    topline = text.split("\n", 1)[0]
-    source = event.source
-    related = source['content'].get('m.relates_to', {}).get('event_id')
-
-    subject = topline if len(topline) < 70 else topline[0:67] + '...'
-
-    mail = EmailMessage()
-    mail.add_header("Subject", topline)
-    mail.add_header("From", mxid_to_email(event.sender))
-    mail.add_header("To", mxid_to_email(room.machine_name))
-    mail.add_header("Message-Id", msg_id(event.event_id))
-    if related:
-        mail.add_header("References", msg_id(related))
-    mail.add_header("Date", formatdate(event.server_timestamp/1000))
-    mail.add_alternative(text)
-    mail.add_alternative(bytes(yaml.dump(source, indent=2), 'utf-8'),
-                         maintype='application', subtype='mxmda',
-                         params={
-                            'type': event.source['type'],
-                            'charset': 'utf-8'
-                         }, cte='8bit')
-
-    return mail
+        self.started = monotonic()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, self.log_metrics)
+        # Shut down cleanly, closing the journal, flushing receipts and
+        # so on, instead of dying where we stand.
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop, signum)
+        self.writer.start()
+        self.pipeline.start()
+        self.receipts.start()
+        self.backfills = asyncio.Semaphore(self.backfill_concurrency)
+        # The first sync continues from the stored token, if there is one.
+        await self.client.prepare()
+        self.since = self.client.loaded_sync_token
+        # The journal must be read before anything new is appended to it.
+        journaled = self.journal.replay() if self.journal else []
+        try:
+            # Queued ahead of anything the first sync brings, which may
+            # be newer events of the same rooms; the room state isn't
+            # known yet, so they are rendered with what the ids tell.
+            await self.replay(journaled)
+            self.logger.debug("Starting client")
+            await self.client.start()
+            #await self.client.msg(self.matrix.room,
+            #                      "i'm online now, awaiting interactions")
+            await self.control.start()
+            if self.outbox:
+                await self.outbox.start()
+            self.logger.info("Matrix initialization complete, entering sync loop")
+            await self.client.enter_loop()
+        finally:
+            if self.outbox:
+                await self.outbox.close()
+            await self.control.close()
+            for task in self.backfill_tasks:
+                task.cancel()
+            await asyncio.gather(*self.backfill_tasks, return_exceptions=True)
+            await self.pipeline.close()
+            await self.receipts.close()
+            self.writer.close()
+            if self.journal:
+                self.journal.close()
+            if self.seen:
+                self.seen.close()
+            self.index.close()
+
+def append_line(filename, line):
+    with open(filename, 'a') as fh:
+        fh.write(line)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def read_source(filename):
+    with open(filename, 'rb') as fh:
+        return event_source(fh.read())
 
 def write_event_to_maildir(app):
+    async def deliver(room, event):
+        fut = await app.writer.submit(render_event(room, event,
+                                                   app.source_format))
+        if not app.delivered:
+            fut.add_done_callback(app.log_first_delivery)
+        # Returns once the mail is on disk; with --fsync, once it has
+        # been fsynced.
+        filename = await fut
+        app.index.add(event.event_id, filename, room.room_id)
+
+    async def find(event_id):
+        row = app.index.get(event_id)
+        if row is None:
+            return None
+        filename = await app.writer.run(app.maildir.locate, *row)
+        if filename is None:
+            app.index.remove(event_id)
+        return filename
+
+    async def edit(room, event):
+        """
+        Rewrite the mail of the event an edit replaces, with the new
+        content. Returns False if there is no such mail to rewrite.
+        """
+        content = event.source['content']
+        new_content = content.get('m.new_content')
+        if not isinstance(new_content, dict):
+            return False
+        event_id = content['m.relates_to']['event_id']
+        filename = await find(event_id)
+        if filename is None:
+            return False
+        original = await app.writer.run(read_source, filename)
+        if original is None or original.get('sender') != event.sender:
+            return False
+
+        # Shaped like an event with a server side aggregated edit.
+        source = dict(original, content=dict(new_content))
+        if 'm.relates_to' in original['content']:
+            source['content']['m.relates_to'] = \
+                original['content']['m.relates_to']
+        source['unsigned'] = dict(original.get('unsigned', {}))
+        source['unsigned']['m.relations'] = {'m.replace': event.source}
+
+        app.logger.info("Rewriting %s for edit %s", event_id, event.event_id)
+        mail = render_event(room, Event.parse_event(source), app.source_format)
+        await app.writer.run(app.maildir.replace, filename, mail)
+        return True
+
+    async def redact(room, event):
+        filename = await find(event.redacts)
+        if filename is None:
+            app.logger.debug("No mail for redacted event %s", event.redacts)
+            return
+        app.logger.info("Flagging %s as trashed for redaction %s",
+                        event.redacts, event.event_id)
+        filename = await app.writer.run(app.maildir.add_flag, filename, 'T')
+        app.index.add(event.redacts, filename, room.room_id)
+
     async def deliverer(room, event):
-        filename = os.path.join(app.maildir, 'new', '_'.join([str(time()), node()]))
-        mail = event_to_email(room, event)
-        with open(filename, 'w') as fh:
-            print(mail, file=fh)
+        if app.seen is not None and event.event_id in app.seen:
+            app.logger.debug("Skipping already delivered event %s",
+                             event.event_id)
+            app.duplicates.inc()
+            return
+        if isinstance(event, mxmda.matrix.RedactionEvent):
+            await redact(room, event)
+        elif not (is_edit(event) and await edit(room, event)):
+            # Edits of mails we don't have are delivered as they are.
+            await deliver(room, event)
+        if app.seen is not None:
+            app.seen.add(event.event_id)
     return deliverer
 
+def is_edit(event):
+    relation = event.source['content'].get('m.relates_to')
+    return isinstance(relation, dict) and \
+           relation.get('rel_type') == 'm.replace' and \
+           'event_id' in relation
+
 class Command(Application):
+    def client_options(self, args):
+        # Commands sync on their own, but the sync token in the store is
+        # the service's; it must only move once its events are delivered.
+        return {'ack_sync_tokens': True}
+
     async def start(self):
         self.logger.debug("Starting client")
         await self.client.start()
         self.logger.info("Matrix initialization complete")
 
-class MsgCommand(Command):
+class ReindexCommand:
+    def __init__(self, args):
+        self.logger = logging.getLogger(mxmda.__name__)
+        self.logger.setLevel(args.log_level)
+        self.maildir = Maildir(args.maildir)
+        self.index = MailIndex(os.path.join(existing_dir(args.state_dir),
+                                            'mailindex.db'))
+        self.jobs = args.jobs
+
+    async def start(self):
+        self.logger.info("Reindexing %s", self.maildir.path)
+        indexed = self.index.rebuild(self.maildir, jobs=self.jobs)
+        self.index.close()
+        self.logger.info("Indexed %d mails", indexed)
+
+class ControlCommand(Command):
+    """
+    A command that the service can do for us. If it's running, the
+    command is forwarded over its control socket; if not, we log in and
+    sync on our own.
+    """
+    # The control command to call, see mxmda.control.commands.
+    command = None
+    # Whether to sync once done, when not forwarded to the service.
+    sync_after = True
+    # Number of control connections, i.e. requests in flight at a time.
+    connections = 1
+    pool = None
+
+    def request(self):
+        return {'command': self.command}
+
+    def show(self, result):
+        pass
+
+    async def connect(self):
+        connections = []
+        for _ in range(self.connections):
+            connection = await mxmda.control.connect(self.control_socket)
+            if connection is None:
+                break
+            connections.append(connection)
+        if connections:
+            self.logger.debug("Forwarding to the service at %s",
+                              self.control_socket)
+            self.pool = asyncio.Queue()
+            for connection in connections:
+                self.pool.put_nowait(connection)
+        else:
+            self.pool = None
+            await super().start()
+
+    async def call(self, request):
+        if self.pool is None:
+            return await mxmda.control.handle(self.client, request)
+        connection = await self.pool.get()
+        try:
+            return await mxmda.control.request(connection, **request)
+        finally:
+            self.pool.put_nowait(connection)
+
+    async def close(self):
+        if self.pool is None:
+            try:
+                if self.sync_after:
+                    await self.client.sync()
+            finally:
+                await self.client.close()
+            return
+        while not self.pool.empty():
+            _, writer = self.pool.get_nowait()
+            writer.close()
+
+    async def start(self):
+        await self.connect()
+        try:
+            result = await self.call(self.request())
+        finally:
+            await self.close()
+        self.show(result)
+
+class MsgCommand(ControlCommand):
+    command = 'msg'
+
     def __init__(self, args):
         super().__init__(args)
-        self.target = args.room
+        self.target = args.target
         self.msg = args.msg
+        self.batch = args.batch
+        self.delimiter = args.delimiter
+        self.concurrency = args.concurrency
+        if self.batch is None:
+            if self.target is None or self.msg is None:
+                raise UserError("Need a --target and a message to send")
+        else:
+            self.connections = self.concurrency
+            if self.msg is not None:
+                raise UserError("Can't send both a message and a --batch")
 
-    async def start(self):
-        await super().start()
+    def request(self):
         self.logger.info("Sending msg to room %s: %s", self.target, self.msg)
-        await self.client.msg(self.target, self.msg)
-        await self.client.sync()
-        await self.client.close()
+        return dict(super().request(), target=self.target, text=self.msg)
+
+    def show(self, result):
+        self.logger.info("Sent as %s", result['event_id'])
+
+    async def send(self, target, text, counts):
+        try:
+            await self.call({'command': self.command, 'target': target,
+                             'text': text})
+        except CommandError as exc:
+            self.logger.error("%s", exc)
+            counts['failed'] += 1
+        else:
+            counts['sent'] += 1
+
+    async def start(self):
+        if self.batch is None:
+            return await super().start()
+
+        fh = sys.stdin if self.batch == '-' else open(self.batch)
+        messages = read_messages(fh, self.delimiter, self.target)
+        counts = {'sent': 0, 'failed': 0}
+        pipeline = Pipeline(self.send,
+                            workers=self.concurrency,
+                            depth=self.concurrency * 4,
+                            key=lambda target, text, counts: target,
+                            logger=self.logger)
+        loop = asyncio.get_running_loop()
+        await self.connect()
+        pipeline.start()
+        try:
+            while True:
+                # Reading stdin may block; don't hold up the senders.
+                message = await loop.run_in_executor(None, next, messages,
+                                                     None)
+                if message is None:
+                    break
+                await pipeline.put(*message, counts)
+            await pipeline.join()
+        finally:
+            await pipeline.close()
+            await self.close()
+            if fh is not sys.stdin:
+                fh.close()
+
+        self.logger.info("Sent %d messages", counts['sent'])
+        if counts['failed']:
+            raise CommandError("Failed to send %d of %d messages" % (
+                counts['failed'], counts['failed'] + counts['sent']
+            ))
+
+def records(fh, separator, size=65536):
+    """Yield the separated records of a file, without reading it all."""
+    buf = ''
+    while True:
+        chunk = fh.read(size)
+        if not chunk:
+            break
+        buf += chunk
+        *complete, buf = buf.split(separator)
+        yield from complete
+    if buf:
+        yield buf
+
+def read_messages(fh, delimiter, target=None):
+    """Yield (target, text) for every message in a --batch input."""
+    if delimiter == 'nul':
+        texts = records(fh, '\0')
+    else:
+        texts = (line.rstrip('\n') for line in fh)
+    for text in texts:
+        if not text.strip():
+            continue
+        msg_target = target
+        if delimiter == 'json':
+            try:
+                msg = json.loads(text)
+            except ValueError as exc:
+                raise UserError("Invalid JSON message %r: %s" % (text, exc))
+            if isinstance(msg, dict):
+                msg_target = msg.get('target', target)
+                text = msg.get('text')
+            else:
+                text = msg
+            if not isinstance(text, str):
+                raise UserError("No text in JSON message %r" % (msg,))
+        if msg_target is None:
+            raise UserError("No --target for message %r" % (text,))
+        yield msg_target, text
 
 class RoomsCommand(Command):
     def __init__(self, args):
         super().__init__(args)
         self.rooms = args.rooms
 
-class RoomlistCommand(Command):
+class RoomlistCommand(ControlCommand):
+    command = 'rooms'
+    sync_after = False
+
     def __init__(self, args):
         super().__init__(args)
         self.list_users = args.list_users
         self.rooms = args.rooms
+        self.offline = args.offline
+        self.refresh = args.refresh
+        self.nio_dir = args.nio_dir
+        self.concurrency = args.concurrency
+        if self.list_users:
+            self.connections = self.concurrency
 
-    def filter(self, room):
-        return not self.rooms or room.room_id in self.rooms \
-                              or room.machine_name in self.rooms
+    def client_options(self, args):
+        return dict(super().client_options(args), resume=args.refresh)
+
+    async def connect(self):
+        await super().connect()
+        # Rooms were loaded from the cache instead of a full state sync.
+        if self.pool is None and not self.client.next_batch:
+            await self.client.catch_up()
+
+    def cached_rooms(self):
+        cache = RoomCache(os.path.join(self.nio_dir, 'rooms.db'))
+        try:
+            return [room for room in cache.room_list(self.list_users)
+                    if not self.rooms or room['room_id'] in self.rooms
+                                      or room['machine_name'] in self.rooms]
+        finally:
+            cache.close()
 
     def fmt(self, room):
         return "%s - %s <%s> (%s users)" % (
-            room.machine_name, room.name, room.room_id, room.member_count
+            room['machine_name'], room['name'], room['room_id'],
+            room['member_count']
         )
 
-    async def start(self):
-        await super().start()
-        for room in filter(self.filter, self.client.rooms.values()):
+    def request(self):
+        return dict(super().request(), rooms=self.rooms)
+
+    def show(self, result):
+        for room in result:
             print(self.fmt(room))
-            if self.list_users:
-                for n in room.users:
-                    print(f' - {n}')
-        await self.client.close()
+            for n in room.get('users', []):
+                print(f' - {n}')
+
+    async def show_members(self, rooms):
+        """
+        Fetch the members of every room, several rooms at a time, and
+        print each room as soon as its members have arrived.
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(room):
+            async with slots:
+                try:
+                    room['users'] = await self.call({
+                        'command': 'members',
+                        'room_id': room['room_id'],
+                    })
+                except CommandError as exc:
+                    self.logger.error("%s", exc)
+            return room
+
+        for done in asyncio.as_completed([fetch(room) for room in rooms]):
+            room = await done
+            self.show([room])
+            # Printed; no need to hold on to the members any longer.
+            room.pop('users', None)
 
-class JoinCommand(RoomsCommand):
     async def start(self):
-        self.logger.info("Joining rooms")
-        await super().start()
-        self.logger.info("Joining rooms: %s", self.rooms)
-        for room in self.rooms:
-            self.logger.info("Joining %s", room)
-            resp = await self.client.join(room)
-            if not isinstance(resp, JoinResponse):
-                self.logger.error("Failed to join room %s: %s", room, resp)
-        await self.client.sync()
-        await self.client.close()
-
-class LeaveCommand(RoomsCommand):
+        if self.offline:
+            self.show(self.cached_rooms())
+            return
+        if not self.list_users:
+            await super().start()
+            return
+        await self.connect()
+        try:
+            await self.show_members(await self.call(self.request()))
+        finally:
+            await self.close()
+
+class ExportCommand(RoomsCommand):
+    def __init__(self, args):
+        super().__init__(args)
+        self.format = args.format
+        self.output = args.output
+        self.checkpoint = args.checkpoint or args.output + '.checkpoint'
+        self.concurrency = args.concurrency
+        self.prefetch = args.prefetch
+        self.source_format = args.source_format
+
+    def filter(self, room):
+        return not self.rooms or room.room_id in self.rooms \
+                              or room.machine_name in self.rooms
+
     async def start(self):
-        self.logger.info("Leaving rooms")
         await super().start()
-        self.logger.info("Leaving rooms: %s", self.rooms)
-        for room in self.rooms:
-            room_obj = await self.client.room_resolve_alias(room)
-            room_id = room_obj.room_id
-            self.logger.info("Leaving %s (%s) - %s", room, room_id, dir(room_id))
-            resp = await self.client.room_leave(room_id)
-            if not isinstance(resp, RoomLeaveResponse):
-                self.logger.error("Failed to leave room %s (%s): %s", room, room_id, resp)
-            resp = await self.client.room_forget(room_id)
-            if not isinstance(resp, RoomForgetResponse):
-                self.logger.error("Failed to foret room %s (%s): %s", room, room_id, resp)
-
-        await self.client.sync()
-        await self.client.close()
+        rooms = [room.room_id for room in
+                 filter(self.filter, self.client.rooms.values())]
+        sink = sinks[self.format](self.output)
+        export = Export(self.client, sink, Checkpoint(self.checkpoint), rooms,
+                        concurrency=self.concurrency,
+                        prefetch=self.prefetch,
+                        source_format=self.source_format,
+                        logger=self.logger)
+        try:
+            exported = await export.run()
+        finally:
+            sink.close()
+            await self.client.close()
+        self.logger.info("Exported %d messages from %d rooms",
+                         exported, len(rooms) - len(export.failed))
+        if export.failed:
+            raise CommandError("Failed to export %d of %d rooms, run again "
+                               "to resume" % (len(export.failed), len(rooms)))
+
+class MembershipCommand(ControlCommand):
+    done = None
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.rooms = args.rooms
+        self.concurrency = args.concurrency
+
+    def request(self):
+        self.logger.info("%s rooms: %s", self.command.capitalize(), self.rooms)
+        return dict(super().request(), rooms=self.rooms,
+                    concurrency=self.concurrency)
+
+    def show(self, result):
+        failed = 0
+        for room, error in result.items():
+            if error:
+                failed += 1
+                print(f'{room}: failed: {error}')
+            else:
+                print(f'{room}: {self.done}')
+        if failed:
+            raise CommandError("Failed to %s %d of %d rooms" % (
+                self.command, failed, len(result)
+            ))
+
+class JoinCommand(MembershipCommand):
+    command = 'join'
+    done = 'joined'
+
+class LeaveCommand(MembershipCommand):
+    command = 'leave'
+    done = 'left'
 
 def command(args):
     return {
@@ -329,5 +1190,7 @@ def command(args):
         'join': JoinCommand,
         'leave': LeaveCommand,
         'rooms': RoomlistCommand,
+        'export': ExportCommand,
+        'reindex': ReindexCommand,
         'service': Service,
     }[args.command](args)
@@ -0,0 +1,221 @@
+"""
+The service's control socket. Commands like msg and join talk to the
+running service over a UNIX socket instead of logging in and syncing
+on their own, which is what makes them slow.
+
+The protocol is one JSON object per line each way: a request with a
+"command" and its arguments, answered by {"ok": true, "result": ...}
+or {"ok": false, "error": "..."}.
+"""
+import asyncio
+import inspect
+import json
+import os
+
+from nio import JoinResponse, RoomForgetResponse, RoomLeaveResponse, \
+                RoomResolveAliasResponse, RoomSendResponse
+
+from mxmda.errors import CommandError, UserError
+
+# The longest line either side accepts. asyncio's default of 64 KiB is
+# not enough for the member list of a large room, or a long room list.
+LINE_LIMIT = 64 * 1024 * 1024
+
+async def msg(client, target, text):
+    resp = await client.limiter.run(lambda: client.msg(target, text))
+    if not isinstance(resp, RoomSendResponse):
+        raise CommandError("Failed to send message to %s: %s" % (target, resp))
+    return {'event_id': resp.event_id}
+
+async def each_room(rooms, action, concurrency):
+    """
+    Run action(room) for several rooms at a time; returns a dict of room
+    to error, None where the action succeeded.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(room):
+        async with slots:
+            try:
+                await action(room)
+            except CommandError as exc:
+                return str(exc)
+        return None
+
+    results = await asyncio.gather(*[run(room) for room in rooms])
+    return dict(zip(rooms, results))
+
+async def join(client, rooms, concurrency=8):
+    """Join rooms; returns a dict of room to error, None if joined."""
+    async def join_room(room):
+        resp = await client.limiter.run(lambda: client.join(room))
+        if not isinstance(resp, JoinResponse):
+            raise CommandError("Failed to join %s: %s" % (room, resp))
+    return await each_room(rooms, join_room, concurrency)
+
+async def resolve(client, room):
+    if not room.startswith('#'):
+        return room
+    resp = await client.limiter.run(lambda: client.room_resolve_alias(room))
+    if not isinstance(resp, RoomResolveAliasResponse):
+        raise CommandError("Failed to resolve %s: %s" % (room, resp))
+    return resp.room_id
+
+async def leave(client, rooms, concurrency=8):
+    """Leave and forget rooms; returns a dict of room to error."""
+    async def leave_room(room):
+        room_id = await resolve(client, room)
+        resp = await client.limiter.run(lambda: client.room_leave(room_id))
+        if not isinstance(resp, RoomLeaveResponse):
+            raise CommandError("Failed to leave %s: %s" % (room_id, resp))
+        resp = await client.limiter.run(lambda: client.room_forget(room_id))
+        if not isinstance(resp, RoomForgetResponse):
+            raise CommandError("Failed to forget %s: %s" % (room_id, resp))
+    return await each_room(rooms, leave_room, concurrency)
+
+def room_info(room):
+    return {
+        'room_id': room.room_id,
+        'machine_name': room.machine_name,
+        'name': room.name,
+        'member_count': room.member_count,
+    }
+
+async def rooms(client, rooms=None):
+    return [
+        room_info(room)
+        for room in client.rooms.values()
+        if not rooms or room.room_id in rooms or room.machine_name in rooms
+    ]
+
+async def members(client, room_id):
+    # Members are lazy loaded by the sync; room.users is incomplete.
+    return await client.joined_member_ids(room_id)
+
+commands = {
+    'msg': msg,
+    'join': join,
+    'leave': leave,
+    'rooms': rooms,
+    'members': members,
+}
+
+def parse(line):
+    try:
+        request = json.loads(line)
+    except ValueError as exc:
+        raise CommandError("Invalid request: %s" % exc)
+    if not isinstance(request, dict):
+        raise CommandError("Invalid request: not a JSON object")
+    return request
+
+async def handle(client, request):
+    request = dict(request)
+    command = commands.get(request.pop('command', None))
+    if command is None:
+        raise CommandError("Unknown command")
+    try:
+        inspect.signature(command).bind(client, **request)
+    except TypeError as exc:
+        raise CommandError("Invalid arguments: %s" % exc)
+    return await command(client, **request)
+
+class ControlServer:
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            if await available(self.path):
+                raise UserError("A service is already listening on %s" %
+                                self.path)
+            os.unlink(self.path)
+        umask = os.umask(0o077)
+        try:
+            self.server = await asyncio.start_unix_server(self.serve,
+                                                          path=self.path,
+                                                          limit=LINE_LIMIT)
+        finally:
+            os.umask(umask)
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # The rest of the line is still to come; there's no
+                    # telling where the next request would start.
+                    writer.write(encode({'ok': False,
+                                         'error': "Request too large"}))
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                writer.write(await self.respond(line))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, line):
+        try:
+            request = parse(line)
+            self.app.logger.info("Control request: %s", request.get('command'))
+            response = {'ok': True,
+                        'result': await handle(self.app.client, request)}
+        except CommandError as exc:
+            response = {'ok': False, 'error': str(exc)}
+        except Exception as exc:
+            # Network errors and the like; the service must carry on.
+            self.app.logger.exception("Control request failed")
+            response = {'ok': False, 'error': str(exc) or type(exc).__name__}
+        return encode(response)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+def encode(message):
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+async def available(path):
+    try:
+        _, writer = await asyncio.open_unix_connection(path)
+    except (FileNotFoundError, ConnectionError):
+        return False
+    writer.close()
+    return True
+
+async def connect(path):
+    """Connect to a running service; None if there is none."""
+    try:
+        return await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+    except (FileNotFoundError, ConnectionError):
+        return None
+
+async def request(connection, command, **args):
+    reader, writer = connection
+    writer.write(encode(dict(args, command=command)))
+    await writer.drain()
+    try:
+        line = await reader.readline()
+    except ValueError:
+        # Useless from here on; the rest of the response is still to come.
+        writer.close()
+        raise CommandError("The response from the service is too large")
+    if not line:
+        raise CommandError("The service closed the control connection")
+    response = json.loads(line)
+    if not response['ok']:
+        raise CommandError(response['error'])
+    return response['result']
@@ -9,3 +9,9 @@ class ConfigError(UserError):
 
 class MatrixAuthError(UserError):
     "Imbecille user probably supplied bad credz"
+
+class BackfillError(Exception):
+    "The homeserver wouldn't tell us what we missed."
+
+class CommandError(UserError):
+    "The homeserver, or the service, said no. Maybe the user's fault."
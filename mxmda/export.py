@@ -0,0 +1,191 @@
+import asyncio
+import os
+import re
+import time
+import yaml
+
+from nio import RoomMessagesResponse, RoomMessageText
+
+from mxmda.mail import flatten, mxid_to_email, render_event
+from mxmda.matrix import EVENT_TYPES
+from mxmda.maildir import Maildir, fsync
+
+# mboxrd: every line that looks like a From line, quoted or not, gets
+# one more level of quoting, which makes it reversible.
+_from_line = re.compile(rb'^(>*From )', re.MULTILINE)
+
+class Mbox:
+    """
+    Appends mails to an mbox file. Its position is the size of the file,
+    so that a resumed export can cut off whatever was written after its
+    last checkpoint.
+    """
+    def __init__(self, path):
+        self.fh = open(path, 'ab')
+
+    def position(self):
+        return self.fh.tell()
+
+    def restore(self, position):
+        if position is not None and position < self.fh.tell():
+            self.fh.truncate(position)
+            self.fh.seek(position)
+
+    def write(self, mails):
+        for event, data in mails:
+            date = time.asctime(time.gmtime(event.server_timestamp / 1000))
+            self.fh.write(b'From %s %s\n' % (
+                mxid_to_email(event.sender).encode('utf-8'),
+                date.encode('ascii'),
+            ))
+            self.fh.write(_from_line.sub(rb'>\1', data))
+            self.fh.write(b'\n')
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+class MaildirSink:
+    """Writes mails to a maildir, committing each page as one batch."""
+    def __init__(self, path):
+        self.maildir = Maildir(path)
+
+    def position(self):
+        return None
+
+    def restore(self, position):
+        pass
+
+    def write(self, mails):
+        self.maildir.commit([self.maildir.stage(data) for _, data in mails])
+
+    def close(self):
+        pass
+
+sinks = {
+    'mbox': Mbox,
+    'maildir': MaildirSink,
+}
+
+class Checkpoint:
+    """
+    How far the export of each room has come: the pagination token to
+    continue from, and whether the room is done. Saved, atomically,
+    after every page written.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as fh:
+                state = yaml.safe_load(fh) or {}
+        except FileNotFoundError:
+            state = {}
+        self.rooms = state.get('rooms', {})
+        self.position = state.get('position')
+
+    def update(self, room_id, token, done, position):
+        self.rooms[room_id] = {'token': token, 'done': done}
+        self.position = position
+        tmpname = self.path + '.tmp'
+        with open(tmpname, 'w') as fh:
+            yaml.dump({'rooms': self.rooms, 'position': position}, fh)
+        fsync(tmpname)
+        os.replace(tmpname, self.path)
+
+class Export:
+    """
+    Pages backwards through the history of some rooms, several rooms at
+    a time, and writes every message to a sink. Fetched pages wait in a
+    queue of at most prefetch pages, so fetching goes on while earlier
+    pages are written, and memory use doesn't depend on the size of the
+    rooms.
+    """
+    def __init__(self, client, sink, checkpoint, rooms, concurrency=4,
+                 prefetch=8, page_size=100, source_format='json',
+                 logger=None):
+        self.client = client
+        self.sink = sink
+        self.checkpoint = checkpoint
+        self.rooms = rooms
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.page_size = page_size
+        self.source_format = source_format
+        self.logger = logger
+        self.exported = 0
+        # The rooms that couldn't be fetched, to be resumed by a rerun.
+        self.failed = []
+
+    async def run(self):
+        self.sink.restore(self.checkpoint.position)
+        slots = asyncio.Semaphore(self.concurrency)
+        pages = asyncio.Queue(self.prefetch)
+        writer = asyncio.ensure_future(self.write(pages))
+        try:
+            await unless_failed(writer, asyncio.gather(*[
+                self.fetch(room_id, pages, slots) for room_id in self.rooms
+            ]))
+            await unless_failed(writer, pages.join())
+        finally:
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+        return self.exported
+
+    async def fetch(self, room_id, pages, slots):
+        state = self.checkpoint.rooms.get(room_id, {})
+        if state.get('done'):
+            self.logger.info("%s has already been exported", room_id)
+            return
+        token = state.get('token') or self.client.next_batch
+        message_filter = {'types': list(EVENT_TYPES[RoomMessageText])}
+        async with slots:
+            self.logger.info("Exporting %s", room_id)
+            while token:
+                resp = await self.client.limiter.run(
+                    lambda: self.client.room_messages(
+                        room_id, token, limit=self.page_size,
+                        message_filter=message_filter,
+                    )
+                )
+                if not isinstance(resp, RoomMessagesResponse):
+                    self.logger.error("Failed to fetch messages of %s, "
+                                      "run again to resume: %s", room_id, resp)
+                    self.failed.append(room_id)
+                    return
+                done = not resp.chunk or not resp.end or resp.end == token
+                events = [event for event in resp.chunk
+                          if isinstance(event, RoomMessageText)]
+                await pages.put((room_id, events, resp.end, done))
+                token = None if done else resp.end
+
+    async def write(self, pages):
+        """Write pages until cancelled; only ever returns by failing."""
+        loop = asyncio.get_running_loop()
+        while True:
+            room_id, events, token, done = await pages.get()
+            room = self.client.rooms[room_id]
+            mails = []
+            for event in events:
+                mail = render_event(room, event, self.source_format)
+                mails.append((event, mail if isinstance(mail, bytes)
+                                      else flatten(mail)))
+            await loop.run_in_executor(None, self.sink.write, mails)
+            self.exported += len(mails)
+            self.checkpoint.update(room_id, token, done, self.sink.position())
+            if done:
+                self.logger.info("Done exporting %s", room_id)
+            pages.task_done()
+
+async def unless_failed(task, awaitable):
+    """
+    Await awaitable, unless task fails first; then, cancel awaitable and
+    raise the task's exception instead.
+    """
+    waiting = asyncio.ensure_future(awaitable)
+    await asyncio.wait([task, waiting], return_when=asyncio.FIRST_COMPLETED)
+    if task.done() and not waiting.done():
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        task.result()
+    return waiting.result()
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+import struct
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mxmda.utils import existing_dir
+
+EVENT = 1
+ACK = 2
+
+# kind, record id, payload length, payload crc32
+HEADER = struct.Struct('>BQII')
+
+class Journal:
+    """
+    Append-only journal of received events that have not yet been
+    delivered. Every event is appended when it arrives, and an ack
+    record is appended once it has been delivered; on startup, replay()
+    returns the events that were never acked.
+
+    Records are written to numbered segment files of about segment_size
+    bytes. A segment is removed once every event in it has been acked,
+    which is what keeps the journal from growing without bounds. Acks
+    for events in older segments are written to the current segment,
+    which is thus kept for as long as those older segments are.
+
+    Rotating and removing segments only queues the fsyncs and unlinks
+    it takes; a thread of the journal's own does them, in order, so the
+    event loop never waits for the disk. flush() waits for them.
+    """
+    def __init__(self, path, segment_size=4 * 1024 * 1024):
+        self.path = existing_dir(path)
+        self.segment_size = segment_size
+        self.next_id = 0
+        self.segment = None
+        self.fh = None
+        # segment number -> ids of the unacked events in it
+        self.live = {}
+        self.segment_of = {}
+        # segment number -> the older segments it holds ack records for
+        self.pins = {}
+        # Files of rotated segments, still to be synced and closed.
+        self.closing = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def segments(self):
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.path)
+            if name.endswith('.log') and name[:-4].isdigit()
+        )
+
+    def filename(self, segment):
+        return os.path.join(self.path, '%016d.log' % segment)
+
+    def read(self, segment):
+        """
+        Yield the records of a segment. A torn or corrupt record ends the
+        segment; it can only be the last thing written before a crash.
+        """
+        with open(self.filename(segment), 'rb') as fh:
+            while True:
+                header = fh.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                kind, record_id, length, crc = HEADER.unpack(header)
+                payload = fh.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                yield kind, record_id, payload
+
+    def replay(self):
+        """
+        Load the journal and return the unacked events, oldest first, as
+        (record id, room id, event source) tuples. Must be called before
+        anything is appended.
+        """
+        events = {}
+        segments = self.segments()
+        for segment in segments:
+            self.live[segment] = set()
+            for kind, record_id, payload in self.read(segment):
+                self.next_id = max(self.next_id, record_id + 1)
+                if kind == EVENT:
+                    events[record_id] = json.loads(payload)
+                    self.live[segment].add(record_id)
+                    self.segment_of[record_id] = segment
+                elif kind == ACK and record_id in events:
+                    del events[record_id]
+                    acked = self.segment_of.pop(record_id)
+                    self.live[acked].discard(record_id)
+                    if acked != segment:
+                        self.pins.setdefault(segment, set()).add(acked)
+
+        for segment in segments:
+            if segment in self.live:
+                self.collect(segment)
+
+        self.open((segments[-1] + 1) if segments else 0)
+        return [(record_id, event['room_id'], event['source'])
+                for record_id, event in sorted(events.items())]
+
+    def open(self, segment):
+        previous = self.segment
+        if self.fh:
+            self.closing.append(self.fh)
+        self.segment = segment
+        self.live[segment] = set()
+        self.fh = open(self.filename(segment), 'ab')
+        if previous is not None and previous in self.live:
+            self.collect(previous)
+
+    def removable(self, segment):
+        return segment != self.segment and not self.live[segment] and \
+            not any(pinned in self.live for pinned in self.pins.get(segment, ()))
+
+    def collect(self, segment):
+        """
+        Remove a segment if nothing in it is needed any longer, along with
+        the newer segments that were only kept for its sake.
+        """
+        if not self.removable(segment):
+            return
+        self.remove(segment)
+        for other, pinned in list(self.pins.items()):
+            if segment in pinned and other in self.live:
+                pinned.discard(segment)
+                self.collect(other)
+
+    def remove(self, segment):
+        del self.live[segment]
+        self.pins.pop(segment, None)
+        self.executor.submit(os.unlink, self.filename(segment))
+
+    def write(self, kind, record_id, payload=b''):
+        self.fh.write(HEADER.pack(kind, record_id, len(payload),
+                                  zlib.crc32(payload)))
+        self.fh.write(payload)
+        if self.fh.tell() >= self.segment_size:
+            self.open(self.segment + 1)
+
+    def append(self, room_id, source):
+        """Journal an event, returning the record id to ack it with."""
+        record_id = self.next_id
+        self.next_id += 1
+        self.live[self.segment].add(record_id)
+        self.segment_of[record_id] = self.segment
+        self.write(EVENT, record_id, json.dumps({
+            'room_id': room_id,
+            'source': source,
+        }, separators=(',', ':')).encode('utf-8'))
+        return record_id
+
+    def ack(self, record_id):
+        segment = self.segment_of.pop(record_id)
+        self.live[segment].discard(record_id)
+        if self.removable(segment):
+            self.collect(segment)
+            return
+        if segment != self.segment:
+            # Pinned before writing, which may move on to a new segment.
+            self.pins.setdefault(self.segment, set()).add(segment)
+        self.write(ACK, record_id)
+
+    def _sync(self, closing, fh):
+        for old in closing:
+            old.flush()
+            os.fsync(old.fileno())
+            old.close()
+        if fh:
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    async def flush(self):
+        """Make everything appended so far durable."""
+        closing, self.closing = self.closing, []
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._sync, closing, self.fh
+        )
+
+    def close(self):
+        closing, self.closing = self.closing, []
+        self.executor.submit(self._sync, closing, self.fh).result()
+        self.executor.shutdown()
+        if self.fh:
+            self.fh.close()
+            self.fh = None
@@ -0,0 +1,221 @@
+import io
+import json
+import random
+import re
+import sys
+import yaml
+
+from functools import lru_cache
+from email.generator import BytesGenerator
+from email.policy import default as default_policy
+from email.utils import formatdate
+from email.message import EmailMessage
+from email import message_from_bytes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def mxid_to_email(mxid):
+    if not mxid.startswith(('@', '!', '#')):
+        raise ValueError("Invalid mxid %s" % mxid)
+    return mxid[1:].replace(':', '@', 1)
+
+def email_to_mxid(address, sigil):
+    """Inverse of mxid_to_email(), given the sigil that it dropped."""
+    localpart, at, server = address.rpartition('@')
+    if not at or not localpart:
+        raise ValueError("Invalid address %s" % address)
+    return f'{sigil}{localpart}:{server}'
+
+def msg_id(event_id):
+    # FIXME: example.invalid, we can and should do better.
+    #        how do i access the hs domain? which one? mxmda's hs,
+    #        the room's hs or the originating message hs?
+    return f'<{event_id}@example.invalid>'
+
+def event_id_from_msg_id(value):
+    """Inverse of msg_id(); None for Message-Ids we didn't make."""
+    value = value.strip()
+    if not value.startswith('<$') or not value.endswith('>'):
+        return None
+    event_id, sep, _ = value[1:-1].rpartition('@')
+    return event_id if sep else None
+
+def dump_json(source):
+    if orjson is not None:
+        return orjson.dumps(source)
+    return json.dumps(source, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+def dump_yaml(source):
+    return bytes(yaml.dump(source, indent=2), 'utf-8')
+
+# How the event source is embedded in the application/mxmda part of
+# each mail. JSON is much cheaper to produce than YAML, which used to be
+# the most expensive step in rendering an event.
+source_formats = {
+    'json': dump_json,
+    'yaml': dump_yaml,
+}
+
+def event_to_email(room, event, source_format='json'):
+    text = event.body.strip()
+    topline = text.split("\n", 1)[0]
+    source = event.source
+    related = source['content'].get('m.relates_to', {}).get('event_id')
+
+    subject = topline if len(topline) < 70 else topline[0:67] + '...'
+
+    mail = EmailMessage()
+    mail.add_header("Subject", topline)
+    mail.add_header("From", mxid_to_email(event.sender))
+    mail.add_header("To", mxid_to_email(room.machine_name))
+    mail.add_header("Message-Id", msg_id(event.event_id))
+    if related:
+        mail.add_header("References", msg_id(related))
+    mail.add_header("Date", formatdate(event.server_timestamp/1000))
+    mail.add_alternative(text)
+    mail.add_alternative(source_formats[source_format](source),
+                         maintype='application', subtype='mxmda',
+                         params={
+                            'type': event.source['type'],
+                            'format': source_format,
+                            'charset': 'utf-8'
+                         }, cte='8bit')
+
+    return mail
+
+def event_source(data):
+    """
+    Return the event source embedded in a mail rendered by
+    event_to_email(), or None if there is none.
+    """
+    mail = message_from_bytes(data, policy=policy)
+    for part in mail.walk():
+        if part.get_content_type() != 'application/mxmda':
+            continue
+        payload = part.get_payload(decode=True)
+        if part.get_param('format') == 'json':
+            return json.loads(payload)
+        return yaml.safe_load(payload)
+    return None
+
+# Mails are written with raw UTF-8 headers, and 8bit bodies are kept as
+# is instead of being re-encoded as base64.
+policy = default_policy.clone(utf8=True)
+
+def flatten(mail):
+    buf = io.BytesIO()
+    BytesGenerator(buf, policy=policy).flatten(mail)
+    return buf.getvalue()
+
+# The fast renderer below only handles values that the email package
+# would write back verbatim; anything else goes through EmailMessage.
+_plain_subject = re.compile(r'[^\s\x00-\x1f\x7f](?:[^\x00-\x1f\x7f]*[^\s\x00-\x1f\x7f])?')
+_plain_address = re.compile(r'[A-Za-z0-9._=/+-]+@[A-Za-z0-9.-]+')
+_plain_event_id = re.compile(r'\$[A-Za-z0-9._+/=-]+')
+
+# Same boundary format as email.generator.Generator.
+_boundary_width = len(repr(sys.maxsize - 1))
+
+def _boundary():
+    return '=' * 15 + '%0*d' % (_boundary_width, random.randrange(sys.maxsize)) + '=='
+
+@lru_cache(maxsize=None)
+def _multipart_header(boundary_len):
+    """
+    Content-Type header of the top level multipart/alternative, as the
+    email package folds it, with {boundary} left to fill in.
+    """
+    mail = EmailMessage()
+    mail['Content-Type'] = 'multipart/alternative'
+    mail.set_boundary('x' * boundary_len)
+    header = flatten(mail).split(b'\n\n', 1)[0].decode('ascii')
+    return header.replace('x' * boundary_len, '{boundary}') + '\n'
+
+@lru_cache(maxsize=None)
+def _text_headers(cte):
+    mail = EmailMessage()
+    mail.set_content('x', cte=cte)
+    return flatten(mail).split(b'\n\n', 1)[0] + b'\n\n'
+
+@lru_cache(maxsize=None)
+def _source_headers(event_type, source_format):
+    mail = EmailMessage()
+    mail.set_content(b'x', maintype='application', subtype='mxmda',
+                     params={
+                        'type': event_type,
+                        'format': source_format,
+                        'charset': 'utf-8'
+                     }, cte='8bit')
+    return flatten(mail).split(b'\n\n', 1)[0] + b'\n\n'
+
+def fast_event_to_email(room, event, source_format='json'):
+    """
+    Render a plain RoomMessageText as the exact bytes that flattening
+    event_to_email() would produce, without going through the email
+    package. The part headers are rendered once by the email package
+    and reused. Returns None if the event needs anything the templates
+    don't cover: folded or encoded headers, long lines, and so on.
+    """
+    text = event.body.strip()
+    topline = text.split("\n", 1)[0]
+    source = event.source
+    related = source['content'].get('m.relates_to', {}).get('event_id')
+    sender = mxid_to_email(event.sender)
+    recipient = mxid_to_email(room.machine_name)
+
+    if len(topline) > 69 or not _plain_subject.fullmatch(topline) \
+                         or len(topline.splitlines()) != 1 \
+                         or '=?' in topline:
+        return None
+    if not (_plain_address.fullmatch(sender) and
+            _plain_address.fullmatch(recipient)):
+        return None
+    if not _plain_event_id.fullmatch(event.event_id):
+        return None
+    if related and not _plain_event_id.fullmatch(related):
+        return None
+
+    lines = text.encode('utf-8').splitlines()
+    if not lines or max(len(line) for line in lines) > 78:
+        return None
+    body = b'\n'.join(lines) + b'\n'
+    cte = '7bit' if body.isascii() else '8bit'
+    payload = source_formats[source_format](source)
+
+    boundary = _boundary()
+    delimiter = boundary.encode('ascii')
+    while delimiter in body or delimiter in payload:
+        boundary = _boundary()
+        delimiter = boundary.encode('ascii')
+
+    headers = [
+        f'Subject: {topline}\n',
+        f'From: {sender}\n',
+        f'To: {recipient}\n',
+        f'Message-Id: {msg_id(event.event_id)}\n',
+    ]
+    if related:
+        headers.append(f'References: {msg_id(related)}\n')
+    headers.append(f'Date: {formatdate(event.server_timestamp/1000)}\n')
+    headers.append(_multipart_header(len(boundary)).format(boundary=boundary))
+
+    return b''.join([
+        ''.join(headers).encode('utf-8'),
+        b'\n--', delimiter, b'\n',
+        _text_headers(cte), body,
+        b'\n--', delimiter, b'\n',
+        _source_headers(source['type'], source_format), payload,
+        b'\n--', delimiter, b'--\n',
+    ])
+
+def render_event(room, event, source_format='json'):
+    """
+    Render an event as a mail, either as ready made bytes or, for
+    events the fast path can't handle, as an EmailMessage.
+    """
+    return fast_event_to_email(room, event, source_format) \
+        or event_to_email(room, event, source_format)
@@ -0,0 +1,251 @@
+import asyncio
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from email.generator import BytesGenerator
+from itertools import count
+from platform import node
+from time import time
+
+import mxmda.metrics
+
+from mxmda.mail import policy
+from mxmda.utils import existing_dir
+
+def hostname():
+    # The maildir spec reserves / and : in the host part of file names.
+    return node().replace('/', r'\057').replace(':', r'\072')
+
+class Maildir:
+    def __init__(self, path):
+        self.path = path
+        self.host = hostname()
+        self.seq = count()
+        for subdir in ('cur', 'new', 'tmp'):
+            existing_dir(os.path.join(self.path, subdir))
+
+    def unique_name(self):
+        """
+        Return a file name in the time.MmicroPpidQseq.host format. The
+        sequence number is per process, which makes the name unique even
+        when several writer threads deliver within the same microsecond.
+        """
+        now = time()
+        sec = int(now)
+        usec = int((now - sec) * 1000000)
+        return f'{sec}.M{usec}P{os.getpid()}Q{next(self.seq)}.{self.host}'
+
+    def deliver(self, mail):
+        """
+        Deliver a mail the maildir way: write it to tmp/, then rename it
+        into new/, so readers never see a partially written file.
+        """
+        name = self.stage(mail)
+        filename = os.path.join(self.path, 'new', name)
+        os.rename(os.path.join(self.path, 'tmp', name), filename)
+        return filename
+
+    def stage(self, mail):
+        """
+        Write a mail, an EmailMessage or already rendered bytes, to tmp/
+        and return its name; commit() moves it into new/ later on.
+        """
+        name = self.unique_name()
+        tmpname = os.path.join(self.path, 'tmp', name)
+        try:
+            with open(tmpname, 'wb') as fh:
+                if isinstance(mail, bytes):
+                    fh.write(mail)
+                else:
+                    BytesGenerator(fh, policy=policy).flatten(mail)
+        except BaseException:
+            try:
+                os.unlink(tmpname)
+            except FileNotFoundError:
+                pass
+            raise
+        return name
+
+    def commit(self, names):
+        """
+        Durably move a batch of staged mails into new/: fsync every file,
+        rename them all, then fsync new/ once for the whole batch.
+        """
+        for name in names:
+            fsync(os.path.join(self.path, 'tmp', name))
+        filenames = []
+        for name in names:
+            filename = os.path.join(self.path, 'new', name)
+            os.rename(os.path.join(self.path, 'tmp', name), filename)
+            filenames.append(filename)
+        fsync(os.path.join(self.path, 'new'))
+        return filenames
+
+    def locate(self, name, flags=''):
+        """
+        Return the current path of the mail with the given unique name.
+        Mail readers move mails from new/ to cur/ and change their flags,
+        so the last known flags are tried first, and cur/ is only listed
+        if that fails. Returns None if the mail is gone.
+        """
+        for filename in (os.path.join(self.path, 'new', name),
+                         os.path.join(self.path, 'cur', f'{name}:2,{flags}')):
+            if os.path.exists(filename):
+                return filename
+        prefix = name + ':'
+        with os.scandir(os.path.join(self.path, 'cur')) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix):
+                    return entry.path
+        return None
+
+    def add_flag(self, filename, flag):
+        """Set a flag on a mail, moving it to cur/; returns its new path."""
+        name, flags = split_name(filename)
+        flags = ''.join(sorted(set(flags + flag)))
+        target = os.path.join(self.path, 'cur', f'{name}:2,{flags}')
+        if target != filename:
+            os.rename(filename, target)
+        return target
+
+    def replace(self, filename, mail):
+        """Atomically replace the contents of a delivered mail."""
+        name = self.stage(mail)
+        tmpname = os.path.join(self.path, 'tmp', name)
+        fsync(tmpname)
+        os.replace(tmpname, filename)
+        fsync(os.path.dirname(filename))
+        return filename
+
+def split_name(filename):
+    """Split a maildir file name into its unique name and its flags."""
+    name, _, info = os.path.basename(filename).partition(':')
+    return name, info[2:] if info.startswith('2,') else ''
+
+def fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class GroupCommit:
+    """
+    Collects staged mails and commits them in batches. A batch is
+    committed when it reaches max_batch mails, or when window seconds
+    have passed since its first mail arrived, whichever comes first.
+    The futures returned by add() resolve only once their batch has
+    been fsynced.
+    """
+    def __init__(self, maildir, pool, window=0.005, max_batch=64):
+        self.maildir = maildir
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.full = asyncio.Event()
+        self.flusher = None
+        self.latency = mxmda.metrics.timing('maildir.fsync')
+        self.batches = mxmda.metrics.counter('maildir.fsync_batches')
+        self.files = mxmda.metrics.counter('maildir.fsync_files')
+
+    def add(self, name):
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((name, fut))
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush())
+        return fut
+
+    async def flush(self):
+        try:
+            await asyncio.wait_for(self.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+
+        batch, self.pending = self.pending, []
+        self.full.clear()
+        self.flusher = None
+
+        loop = asyncio.get_running_loop()
+        try:
+            with self.latency.time():
+                filenames = await loop.run_in_executor(
+                    self.pool, self.maildir.commit, [name for name, _ in batch]
+                )
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+
+        self.batches.inc()
+        self.files.inc(len(batch))
+        for (_, fut), filename in zip(batch, filenames):
+            if not fut.done():
+                fut.set_result(filename)
+
+class MaildirWriter:
+    """
+    Writes mails to a Maildir from a pool of worker threads, so that disk
+    I/O never runs in the event loop. At most workers + queue_depth mails
+    are in flight at any time; submitting more waits for a free slot,
+    which is what keeps a burst of events from piling up in memory.
+
+    With fsync_window set, deliveries are made durable through a
+    GroupCommit, and a delivery is not complete until its batch has
+    been fsynced.
+    """
+    def __init__(self, maildir, workers=4, queue_depth=64,
+                 fsync_window=None, fsync_batch=64):
+        self.maildir = maildir
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.fsync_window = fsync_window
+        self.fsync_batch = fsync_batch
+        self.pool = None
+        self.slots = None
+        self.committer = None
+
+    def start(self):
+        self.pool = ThreadPoolExecutor(max_workers=self.workers,
+                                       thread_name_prefix='mxmda-writer')
+        self.slots = asyncio.Semaphore(self.workers + self.queue_depth)
+        if self.fsync_window is not None:
+            self.committer = GroupCommit(self.maildir, self.pool,
+                                         window=self.fsync_window,
+                                         max_batch=self.fsync_batch)
+
+    async def submit(self, mail):
+        """
+        Queue a mail for writing, waiting only for a free slot. Returns a
+        future resolving to the path of the delivered file.
+        """
+        await self.slots.acquire()
+        fut = asyncio.ensure_future(self._deliver(mail))
+        fut.add_done_callback(self._done)
+        return fut
+
+    async def _deliver(self, mail):
+        loop = asyncio.get_running_loop()
+        if self.committer is None:
+            return await loop.run_in_executor(self.pool,
+                                              self.maildir.deliver, mail)
+        name = await loop.run_in_executor(self.pool, self.maildir.stage, mail)
+        return await self.committer.add(name)
+
+    async def deliver(self, mail):
+        return await (await self.submit(mail))
+
+    async def run(self, fn, *args):
+        """Run some other maildir operation on the writer threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, fn, *args)
+
+    def _done(self, fut):
+        self.slots.release()
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=True)
@@ -0,0 +1,115 @@
+import os
+import re
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor
+
+from mxmda.mail import event_id_from_msg_id
+from mxmda.maildir import split_name
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mails (
+    event_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    room_id TEXT
+);
+"""
+
+_message_id = re.compile(rb'message-id:[ \t]*(.*?)\s*$', re.IGNORECASE)
+
+def read_event_id(filename):
+    """
+    Return the event id from the Message-Id header of a mail, reading
+    no further than its headers.
+    """
+    try:
+        with open(filename, 'rb') as fh:
+            for line in fh:
+                if not line.strip():
+                    break
+                match = _message_id.match(line)
+                if match:
+                    return event_id_from_msg_id(match.group(1).decode(
+                        'utf-8', 'replace'
+                    ))
+    except FileNotFoundError:
+        pass
+    return None
+
+class MailIndex:
+    """
+    Maps event ids to the maildir files they were delivered to, so that
+    edits and redactions can find the mail of an earlier event without
+    scanning the maildir. Files are indexed by their unique name and
+    last known flags; Maildir.locate() takes care of finding them if a
+    mail reader has moved them around since. The room of each event is
+    kept too, for replies to find their way back to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.executescript(SCHEMA)
+            columns = [row[1] for row in
+                       self._db.execute("PRAGMA table_info(mails)")]
+            if 'room_id' not in columns:
+                # Indexes made before rooms were kept.
+                self._db.execute("ALTER TABLE mails ADD COLUMN room_id TEXT")
+        return self._db
+
+    def add(self, event_id, filename, room_id=None):
+        name, flags = split_name(filename)
+        with self.db as db:
+            db.execute("INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?)",
+                       (event_id, name, flags, room_id))
+
+    def get(self, event_id):
+        """Return the (unique name, flags) of an event's mail, or None."""
+        return self.db.execute("SELECT name, flags FROM mails "
+                               "WHERE event_id = ?", (event_id,)).fetchone()
+
+    def room(self, event_id):
+        """Return the room id of an event's mail, or None."""
+        row = self.db.execute("SELECT room_id FROM mails WHERE event_id = ?",
+                              (event_id,)).fetchone()
+        return row[0] if row else None
+
+    def remove(self, event_id):
+        with self.db as db:
+            db.execute("DELETE FROM mails WHERE event_id = ?", (event_id,))
+
+    def rebuild(self, maildir, jobs=None):
+        """
+        Index every mail in the maildir from scratch, reading headers
+        from a pool of processes. Returns the number of mails indexed.
+        Rooms can't be told from the headers, and are forgotten.
+        """
+        filenames = [
+            entry.path
+            for subdir in ('new', 'cur')
+            for entry in os.scandir(os.path.join(maildir.path, subdir))
+        ]
+        indexed = 0
+        with ProcessPoolExecutor(max_workers=jobs) as pool, self.db as db:
+            db.execute("DELETE FROM mails")
+            for filename, event_id in zip(filenames, pool.map(
+                read_event_id, filenames, chunksize=256
+            )):
+                if event_id is None:
+                    continue
+                db.execute("INSERT OR REPLACE INTO mails VALUES "
+                           "(?, ?, ?, NULL)", (event_id, *split_name(filename)))
+                indexed += 1
+        return indexed
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
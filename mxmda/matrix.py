@@ -1,14 +1,21 @@
 import asyncio
+import hashlib
 import html
+import json
 import logging
-import requests
+import os
+import time
 from urllib.parse import urlparse
 
+import aiohttp
+
 from nio import (
-    AsyncClient, ClientConfig, MatrixRoom,
+    Api, AsyncClient, AsyncClientConfig, MatrixRoom,
     ToDeviceError, LocalProtocolError,
-    Event, RoomMessageText, AccountDataEvent, EphemeralEvent, ToDeviceEvent,
-    LoginResponse, SyncResponse, UpdateReceiptMarkerResponse,
+    Event, RoomMessageText, RedactionEvent,
+    AccountDataEvent, EphemeralEvent, ToDeviceEvent,
+    ErrorResponse, LoginResponse, SyncResponse, SyncError,
+    UploadFilterResponse, RoomMessagesResponse,
 
     KeyVerificationEvent,
     KeyVerificationStart,
@@ -18,14 +25,45 @@ from nio import (
 )
 from nio.store.database import DefaultStore
 
+from mxmda.ratelimit import RateLimiter, rate_limited
+from mxmda.roomcache import RoomCache
 from mxmda.utils import existing_dir
-from mxmda.errors import MatrixAuthError
+from mxmda.errors import BackfillError, CommandError, ConfigError, \
+                         MatrixAuthError
+
+# Timeline event types to ask the homeserver for, per nio event class that
+# we register callbacks for. Encrypted rooms deliver everything as
+# m.room.encrypted, which nio decrypts into the actual event classes.
+EVENT_TYPES = {
+    RoomMessageText: ('m.room.message', 'm.room.encrypted'),
+    RedactionEvent: ('m.room.redaction',),
+}
 
-def autodiscover_hs(uid):
+# State changes arrive in the timeline of incremental syncs; these are
+# the ones we need to keep track of room names, members and encryption.
+STATE_TYPES = (
+    'm.room.canonical_alias',
+    'm.room.encryption',
+    'm.room.member',
+    'm.room.name',
+)
+
+async def autodiscover_hs(uid):
     url = f"https://{uid[1:].split(':')[1]}/.well-known/matrix/client"
-    resp = requests.get(url)
-    resp.raise_for_status()
-    return resp.json()['m.homeserver']['base_url']
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            # .well-known is often served without a JSON content type.
+            body = await resp.json(content_type=None)
+    return body['m.homeserver']['base_url']
+
+def cached_hs(device, ttl):
+    """The discovered homeserver from the device file, unless too old."""
+    cached = device.get('homeserver')
+    if isinstance(cached, dict) and time.time() - cached['discovered'] < ttl:
+        return cached['url']
+    return None
 
 class Client(AsyncClient):
     def __init__(self, *args,
@@ -36,33 +74,107 @@ class Client(AsyncClient):
                  nio_store=DefaultStore,
                  log_level=logging.INFO,
                  timeout=30,
+                 full_state=False,
+                 resume=False,
+                 ack_sync_tokens=False,
+                 retry_delay=5,
                  **kwargs):
-        device = device or {}
-        hs = config.get('homeserver') or autodiscover_hs(config['user'])
+        # Not "device or {}": the application updates this very dict.
+        if device is None:
+            device = {}
+        # Without a configured or cached homeserver, it's discovered in
+        # prepare(), which needs the event loop.
+        hs = config.get('homeserver') or \
+             cached_hs(device, config.get('homeserver_ttl', 86400))
         super().__init__(
-            hs, config['user'],
+            hs or '', config['user'],
             device_id=device.get('device_id'),
             store_path=existing_dir(nio_dir),
-            config=ClientConfig(store=nio_store, store_sync_tokens=True),
+            # With ack_sync_tokens, the token is not stored as soon as a
+            # sync response arrives, but when commit_sync_token() says so.
+            config=AsyncClientConfig(store=nio_store,
+                                     store_sync_tokens=not ack_sync_tokens),
             **kwargs
         )
 
         self.mxmda = app
         self.timeout = timeout * 1000
+        self.full_state = full_state
+        self.resume = resume
+        self.ack_sync_tokens = ack_sync_tokens
+        self.retry_delay = retry_delay
+        self.room_cache = RoomCache(os.path.join(nio_dir, 'rooms.db'))
+        self.limiter = RateLimiter()
+        self.stopping = False
+        self.syncing = None
         self.mxmda_device = device
         self.mxmda_config = config
+        self.prepared = False
+        # Set up by setup_sync_filter(), unless syncing unfiltered.
+        self.sync_filter = None
 
         self.add_log_callbacks(info=log_level <= logging.INFO,
                                debug=log_level <= logging.DEBUG)
         self.add_response_callback(sync(self.mxmda), SyncResponse)
+        self.add_response_callback(self.cache_rooms, SyncResponse)
+        # nio retries rate limited requests on its own, but tells us
+        # first; every other request is then held back too.
+        self.add_response_callback(self.throttled, ErrorResponse)
         self.add_to_device_callback(key_verify(self.mxmda),
                                     KeyVerificationEvent)
 
-        if self.mxmda_device:
+        if self.mxmda_device.get('access_token'):
             self.access_token = self.mxmda_device['access_token']
             self.device_id = self.mxmda_device['device_id']
             self.user_id = self.mxmda_device['user_id']
-            self.load_store()
+
+    async def prepare(self):
+        """
+        Discover the homeserver, if needed, while loading the store in a
+        thread. Done by start(), but may be called earlier to get at the
+        store before the first sync.
+        """
+        if self.prepared:
+            return
+        self.prepared = True
+        tasks = []
+        if not self.homeserver:
+            tasks.append(self.discover())
+        if self.access_token:
+            tasks.append(asyncio.get_running_loop().run_in_executor(
+                None, self.load_store
+            ))
+        await asyncio.gather(*tasks)
+
+    async def discover(self):
+        try:
+            hs = await autodiscover_hs(self.user)
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                KeyError, TypeError, ValueError) as exc:
+            cached = self.mxmda_device.get('homeserver')
+            if not isinstance(cached, dict):
+                raise ConfigError("Unable to discover the homeserver of "
+                                  "%s: %s" % (self.user, exc))
+            self.mxmda.logger.warning("Unable to discover the homeserver, "
+                                      "using %s from before: %s",
+                                      cached['url'], exc)
+            hs = cached['url']
+        else:
+            self.mxmda.logger.info("Discovered homeserver %s", hs)
+            self.mxmda.update_device(homeserver={
+                'url': hs,
+                'discovered': int(time.time()),
+            })
+        self.homeserver = hs
+
+    def load_store(self):
+        super().load_store()
+        if self.ack_sync_tokens and self.store:
+            self.loaded_sync_token = self.store.load_sync_token()
+
+    def commit_sync_token(self, token):
+        if self.store:
+            self.store.save_sync_token(token)
 
     def add_log_callbacks(self, info=True, debug=False):
         if info: self.add_info_log_callbacks()
@@ -109,40 +221,263 @@ class Client(AsyncClient):
         })
 
     async def start(self):
+        await self.prepare()
+
         if not self.access_token:
             self.mxmda.logger.info("No access_token available, logging in")
             await self.login()
 
+        await self.setup_sync_filter()
+
+        if self.resume and self.loaded_sync_token:
+            rooms = self.room_cache.load(self.user_id)
+            if rooms:
+                self.rooms.update(rooms)
+                self.mxmda.logger.info("Resuming from stored sync token, "
+                                       "%d rooms loaded from cache", len(rooms))
+                return
+
         self.mxmda.logger.info("Doing initial matrix state sync")
-        await self.sync(timeout=10 * 1000, full_state=True)
+        resp = await self.sync(timeout=10 * 1000, full_state=True,
+                               sync_filter=self.sync_filter)
+        await self.run_response_callbacks([resp])
         self.mxmda.logger.info("Matrix state sync complete")
 
+    async def joined_member_ids(self, room_id):
+        """
+        Fetch the ids of a room's joined members from the homeserver. Unlike
+        nio's joined_members(), this doesn't add them all to the room, so
+        memory doesn't grow with every large room listed.
+        """
+        path = Api._build_path(['rooms', room_id, 'joined_members'])
+        headers = {'Authorization': 'Bearer %s' % self.access_token}
+
+        async def request():
+            transport_response = await self.send('GET', path, headers=headers)
+            try:
+                body = json.loads(await transport_response.text())
+            except ValueError:
+                # A proxy's error page, and the like.
+                body = {}
+            if transport_response.status == 200 and \
+               isinstance(body.get('joined'), dict):
+                return list(body['joined'])
+            resp = ErrorResponse.from_dict(body)
+            if resp.message == "unknown error":
+                resp.message = "HTTP %d" % transport_response.status
+            resp.transport_response = transport_response
+            return resp
+
+        # Sent as is, without nio's retries; rate limited answers are
+        # retried here instead, sharing the backoff all the same.
+        while True:
+            resp = await self.limiter.run(request)
+            if not rate_limited(resp):
+                break
+            self.limiter.backoff(resp.retry_after_ms)
+        if isinstance(resp, ErrorResponse):
+            raise CommandError("Failed to get members of %s: %s" %
+                               (room_id, resp))
+        return resp
+
+    async def catch_up(self):
+        """
+        One incremental sync from where the last one left off, to bring
+        rooms loaded from the room cache up to date.
+        """
+        resp = await self.sync(timeout=0, sync_filter=self.sync_filter)
+        await self.run_response_callbacks([resp])
+
+    async def throttled(self, response):
+        if rate_limited(response):
+            self.limiter.backoff(response.retry_after_ms)
+
+    async def cache_rooms(self, response):
+        """
+        Store the rooms whose state changed in this sync response in the
+        room cache, and drop the rooms we have left.
+        """
+        changed = [
+            self.rooms[room_id]
+            for room_id, info in response.rooms.join.items()
+            if room_id in self.rooms and (
+                info.state or info.summary or any(
+                    'state_key' in event.source for event in info.timeline.events
+                )
+            )
+        ]
+        left = list(response.rooms.leave)
+        if changed or left:
+            self.room_cache.save(changed, left)
+
+    def event_types(self):
+        """
+        The timeline event types we have callbacks for, plus the
+        sync_event_types listed in the config.
+        """
+        types = set(self.mxmda_config.get('sync_event_types', []))
+        for cb in self.event_callbacks:
+            filters = cb.filter if isinstance(cb.filter, tuple) else (cb.filter,)
+            for cls in filters:
+                types.update(EVENT_TYPES.get(cls, ()))
+        return types
+
+    def sync_filter_definition(self):
+        """
+        Build a sync filter that only lets through what we have callbacks
+        for, plus the sync_event_types listed in the config, and the state
+        changes that keep our rooms up to date. Presence, account data,
+        receipts and typing notifications are dropped, and member lists
+        are lazy loaded.
+        """
+        types = self.event_types() | set(STATE_TYPES)
+
+        return {
+            'presence': {'types': []},
+            'account_data': {'types': []},
+            'room': {
+                'state': {'lazy_load_members': True},
+                'timeline': {
+                    'types': sorted(types),
+                    'lazy_load_members': True,
+                },
+                'ephemeral': {'types': []},
+                'account_data': {'types': []},
+            },
+        }
+
+    async def setup_sync_filter(self):
+        """
+        Upload the sync filter, unless the device file says we already
+        have uploaded this exact filter. The service and the commands
+        sync with different filters; every filter uploaded is kept in the
+        device file. Set sync_filter: false in the config to sync
+        unfiltered.
+        """
+        if self.mxmda_config.get('sync_filter', True) is False:
+            return
+
+        definition = self.sync_filter_definition()
+        digest = hashlib.sha256(
+            json.dumps(definition, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+        uploaded = self.mxmda_device.get('sync_filters') or {}
+        if digest in uploaded:
+            self.sync_filter = uploaded[digest]
+            return
+
+        resp = await self.upload_filter(**definition)
+        if not isinstance(resp, UploadFilterResponse):
+            self.mxmda.logger.warning("Unable to upload sync filter, "
+                                      "sending it inline instead: %s", resp)
+            self.sync_filter = definition
+            return
+
+        self.mxmda.logger.info("Uploaded sync filter %s", resp.filter_id)
+        self.sync_filter = resp.filter_id
+        self.mxmda.update_device(sync_filters=dict(uploaded, **{
+            digest: resp.filter_id,
+        }))
+
+    async def backfill(self, room_id, start, end, limit=1000):
+        """
+        Page back through a room's timeline from start, the prev_batch of
+        a limited timeline, to end, the token the limited sync was made
+        from, and return the events in between, oldest first. Gives up
+        after limit events.
+        """
+        types = self.event_types()
+        message_filter = {'types': sorted(types)} if types else None
+        events = []
+        while start and len(events) < limit:
+            resp = await self.limiter.run(lambda: self.room_messages(
+                room_id, start, end=end, limit=min(100, limit - len(events)),
+                message_filter=message_filter,
+            ))
+            if not isinstance(resp, RoomMessagesResponse):
+                raise BackfillError("Failed to fetch messages of %s: %s" %
+                                    (room_id, resp))
+            if not resp.chunk or resp.end == start:
+                break
+            events.extend(resp.chunk)
+            start = resp.end
+        events.reverse()
+        return events
+
     async def enter_loop(self):
-        await self.sync_forever(timeout=self.timeout, full_state=True)
+        """
+        Long-poll for new events, forever. Syncs are incremental from the
+        last sync token; the full room state is only requested if asked
+        for (full_state), or to recover after a failed sync.
+
+        This does what nio's sync_forever does, but lets us decide on
+        full_state for every iteration instead of just the first one.
+        """
+        full_state = self.full_state
+        while not self.stopping:
+            tasks = [
+                asyncio.ensure_future(self.sync(timeout=self.timeout,
+                                                sync_filter=self.sync_filter,
+                                                full_state=full_state or None)),
+                asyncio.ensure_future(self.send_to_device_messages()),
+            ]
+            if self.should_upload_keys:
+                tasks.append(asyncio.ensure_future(self.keys_upload()))
+            if self.should_query_keys:
+                tasks.append(asyncio.ensure_future(self.keys_query()))
+            if self.should_claim_keys:
+                tasks.append(asyncio.ensure_future(
+                    self.keys_claim(self.get_users_for_key_claiming())
+                ))
+
+            self.syncing = tasks[0]
+            try:
+                for response in asyncio.as_completed(tasks):
+                    await self.run_response_callbacks([await response])
+            except asyncio.CancelledError:
+                for task in tasks:
+                    task.cancel()
+                if self.stopping and tasks[0].cancelled():
+                    # By stop(); nothing of this sync has been committed.
+                    break
+                raise
+            finally:
+                self.syncing = None
+
+            if isinstance(tasks[0].result(), SyncError):
+                self.mxmda.logger.warning(
+                    "Sync failed (%s), retrying with full state in %ss",
+                    tasks[0].result(), self.retry_delay
+                )
+                full_state = True
+                await asyncio.sleep(self.retry_delay)
+            else:
+                full_state = self.full_state
 
-        # Something made us cleanly leave the sync_forever loop. What could
-        # cause that?  While I don't think closing the client connection is
-        # our biggest concern in this case, I see no point in removing this.
-        # Note well that I have not actually seen this.
+        # Something called stop(), making us cleanly leave the sync loop.
         await self.close()
 
-async def read_receipt(app, room, event):
-    marker = await app.client.update_receipt_marker(room.room_id,
-                                                    event.event_id,
-                                                    'm.read')
-    if not isinstance(marker, UpdateReceiptMarkerResponse):
-        app.logger.warning("Unable to update read marker for %s in %s",
-                           event.event_id, room.room_id)
+    def stop(self):
+        """
+        Leave the sync loop, without waiting for the long poll in progress
+        to end. Safe to call before the loop has been entered.
+        """
+        self.stopping = True
+        if self.syncing is not None:
+            self.syncing.cancel()
 
 def msg_callback(app, name, callback):
     """
     Takes a callback and wrap it in common behavior for message handling,
-    including event logging and sending read receipts.
+    including event logging and marking the event for a read receipt.
+    The receipt is only marked once the callback has returned, i.e. the
+    message has been delivered.
     """
     async def common(room, event):
         app.logger.info("Considering msg event for %s callback", name)
-        await asyncio.gather(read_receipt(app, room, event),
-                             callback(room, event))
+        await callback(room, event)
+        app.receipts.mark(room, event)
     return common
 
 def sync(app):
@@ -0,0 +1,59 @@
+"""
+Process wide counters and timings. They are cheap enough to update from
+hot paths, and a snapshot can be logged or handed out on request.
+"""
+from contextlib import contextmanager
+from time import monotonic
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @contextmanager
+    def time(self):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0,
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+registry = {}
+
+def _metric(cls, name):
+    metric = registry.setdefault(name, cls())
+    if not isinstance(metric, cls):
+        raise TypeError(f"metric {name} is a {type(metric).__name__}")
+    return metric
+
+def counter(name):
+    return _metric(Counter, name)
+
+def timing(name):
+    return _metric(Timing, name)
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in sorted(registry.items())}
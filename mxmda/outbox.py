@@ -0,0 +1,252 @@
+"""
+Sends the mails dropped in an outbox maildir to Matrix. In-Reply-To is
+mapped back to the event being replied to, and that to the room it was
+delivered from; mails that aren't replies go to the room they are
+addressed to, the inverse of how events are rendered as mails.
+"""
+import asyncio
+import ctypes
+import hashlib
+import os
+import struct
+
+from email import message_from_binary_file
+
+from nio import RoomSendResponse
+
+import mxmda.control
+import mxmda.metrics
+
+from mxmda.errors import CommandError
+from mxmda.mail import email_to_mxid, event_id_from_msg_id, mxid_to_email, \
+                       policy
+from mxmda.maildir import Maildir
+from mxmda.pipeline import Pipeline
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# wd, mask, cookie, name length; followed by the name
+_inotify_event = struct.Struct('iIII')
+
+class Inotify:
+    """Just enough of inotify(7), through libc, to watch a directory."""
+    def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify is not available")
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed on %s" % path)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return the names of the files with events since last read."""
+        names = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(buf):
+                _, _, _, length = _inotify_event.unpack_from(buf, offset)
+                offset += _inotify_event.size
+                names.append(os.fsdecode(buf[offset:offset + length]
+                                         .rstrip(b'\0')))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+def parse(filename):
+    """
+    Return the To and Cc addresses, the events referred to, the one
+    replied to first, and the text of a mail.
+    """
+    with open(filename, 'rb') as fh:
+        mail = message_from_binary_file(fh, policy=policy)
+    addresses = [address.addr_spec
+                 for header in ('To', 'Cc') if mail[header]
+                 for address in mail[header].addresses]
+    if not addresses:
+        raise CommandError("No To address in %s" % filename)
+    msg_ids = str(mail['In-Reply-To'] or '').split() + \
+              str(mail['References'] or '').split()[::-1]
+    references = [event_id for event_id in map(event_id_from_msg_id, msg_ids)
+                  if event_id]
+    body = mail.get_body(preferencelist=('plain',))
+    text = body.get_content().strip() if body is not None else ''
+    return addresses, references, text or str(mail['Subject'] or '')
+
+class Outbox:
+    """
+    Watches the new/ directory of an outbox maildir, with inotify or, if
+    that's not available, by polling. Every mail that shows up there is
+    sent to its room, see room_for(), from a pool of senders; mails to
+    the same room are sent in the order they arrived. Sent mails are
+    moved to cur/ and flagged as seen, failed ones are flagged.
+
+    The transaction id of each send is derived from the mail's unique
+    maildir name, so when a send is retried, after an error or a
+    restart, the homeserver knows it's the same message.
+    """
+    def __init__(self, app, path, senders=4, poll_interval=5):
+        self.app = app
+        self.maildir = Maildir(path)
+        self.new = os.path.join(self.maildir.path, 'new')
+        self.poll_interval = poll_interval
+        self.pipeline = Pipeline(self.send, workers=senders,
+                                 key=lambda room_id, *_: room_id,
+                                 logger=app.logger)
+        self.incoming = None
+        self.queued = set()
+        self.inotify = None
+        self.tasks = []
+        self.sent = mxmda.metrics.counter('outbox.sent')
+        self.failed = mxmda.metrics.counter('outbox.failed')
+
+    async def start(self):
+        self.incoming = asyncio.Queue()
+        self.pipeline.start()
+        self.tasks.append(asyncio.ensure_future(self.feed()))
+        try:
+            self.inotify = Inotify(self.new)
+        except OSError as exc:
+            self.app.logger.warning("Polling the outbox every %ss: %s",
+                                    self.poll_interval, exc)
+            self.tasks.append(asyncio.ensure_future(self.poll()))
+        else:
+            asyncio.get_running_loop().add_reader(self.inotify.fileno(),
+                                                  self.notified)
+        # Whatever arrived while we weren't watching.
+        self.scan()
+
+    def queue(self, name):
+        if name not in self.queued:
+            self.queued.add(name)
+            self.incoming.put_nowait(name)
+
+    def scan(self):
+        # Unique names start with the delivery time, oldest first.
+        for name in sorted(os.listdir(self.new)):
+            if not name.startswith('.'):
+                self.queue(name)
+
+    def notified(self):
+        for name in self.inotify.read():
+            if name and not name.startswith('.'):
+                self.queue(name)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.scan()
+
+    async def feed(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            name = await self.incoming.get()
+            filename = os.path.join(self.new, name)
+            try:
+                addresses, references, text = await loop.run_in_executor(
+                    None, parse, filename
+                )
+                room_id = await self.room_for(addresses, references)
+            except FileNotFoundError:
+                self.queued.discard(name)
+                continue
+            except CommandError as exc:
+                self.app.logger.error("Unable to send %s: %s", name, exc)
+                self.failed.inc()
+                await self.done(name, filename, 'F')
+                continue
+            except Exception:
+                # Anything from an unknown charset to a network error;
+                # one bad mail must not hold up the ones after it.
+                self.app.logger.exception("Unable to send %s", name)
+                self.failed.inc()
+                await self.done(name, filename, 'F')
+                continue
+            reply_to = references[0] if references else None
+            await self.pipeline.put(room_id, name, filename, reply_to, text)
+
+    async def room_for(self, addresses, references):
+        """
+        The room of the events a mail refers to, if we delivered them.
+        Otherwise, as a reply from a mail reader is addressed to the
+        sender, the first of its addresses that is a room.
+        """
+        for event_id in references:
+            room_id = self.app.index.room(event_id)
+            if room_id is not None:
+                return room_id
+        for address in addresses:
+            for room in self.app.client.rooms.values():
+                if address in (mxid_to_email(room.room_id),
+                               mxid_to_email(room.machine_name)):
+                    return room.room_id
+        for address in addresses:
+            try:
+                return await mxmda.control.resolve(
+                    self.app.client, email_to_mxid(address, '#')
+                )
+            except (CommandError, ValueError):
+                continue
+        raise CommandError("None of %s is a room" % ", ".join(addresses))
+
+    async def send(self, room_id, name, filename, reply_to, text):
+        content = {'msgtype': 'm.text', 'body': text}
+        if reply_to:
+            content['m.relates_to'] = {'m.in_reply_to': {'event_id': reply_to}}
+        tx_id = 'mxmda-' + hashlib.sha256(name.encode('utf-8')).hexdigest()[:32]
+        client = self.app.client
+        try:
+            resp = await client.limiter.run(lambda: client.room_send(
+                room_id, 'm.room.message', content, tx_id=tx_id
+            ))
+        except Exception:
+            # Left in new/, to be retried on the next start.
+            self.app.logger.exception("Failed to send %s to %s",
+                                      name, room_id)
+            return
+        if isinstance(resp, RoomSendResponse):
+            self.app.logger.info("Sent %s to %s as %s",
+                                 name, room_id, resp.event_id)
+            self.sent.inc()
+            await self.done(name, filename, 'S')
+        else:
+            self.app.logger.error("Failed to send %s to %s: %s",
+                                  name, room_id, resp)
+            self.failed.inc()
+            await self.done(name, filename, 'F')
+
+    async def done(self, name, filename, flag):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.maildir.add_flag,
+                                       filename, flag)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            self.app.logger.error("Unable to flag %s: %s", name, exc)
+        self.queued.discard(name)
+
+    async def close(self):
+        if self.inotify is not None:
+            asyncio.get_running_loop().remove_reader(self.inotify.fileno())
+            self.inotify.close()
+            self.inotify = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.pipeline.close()
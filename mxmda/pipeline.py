@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+from collections import deque
+
+import mxmda
+
+class Pipeline:
+    """
+    Runs handler(*item) for every item put() on the pipeline, from a
+    number of worker tasks. At most depth items are queued; put() waits
+    while the pipeline is full, which holds back whoever is feeding it
+    (the sync loop) until the workers catch up.
+
+    If a key function is given, items with the same key(*item) are
+    handled one at a time, in the order they were put, while items with
+    different keys are spread over the workers. A key with a long
+    backlog only ever occupies one worker, so it can't hold up the
+    others.
+    """
+    def __init__(self, handler, workers=4, depth=256, key=None, logger=None):
+        self.handler = handler
+        self.workers = workers
+        self.depth = depth
+        self.key = key
+        self.logger = logger or logging.getLogger(mxmda.__name__)
+        self.slots = None
+        self.ready = None
+        self.pending = {}
+        self.tasks = []
+
+    def start(self):
+        self.slots = asyncio.Semaphore(self.depth)
+        # Keys with queued items and no worker currently handling them.
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.ensure_future(self.work())
+                      for _ in range(self.workers)]
+
+    async def put(self, *item):
+        await self.slots.acquire()
+        key = self.key(*item) if self.key else object()
+        queue = self.pending.get(key)
+        if queue is None:
+            self.pending[key] = deque([item])
+            self.ready.put_nowait(key)
+        else:
+            queue.append(item)
+
+    async def work(self):
+        while True:
+            key = await self.ready.get()
+            queue = self.pending[key]
+            item = queue[0]
+            try:
+                await self.handler(*item)
+            except Exception:
+                self.logger.exception("Failed to process %s", item)
+            finally:
+                # The item stays at the head of its queue while it is
+                # being handled, so that put() won't make the key ready
+                # for another worker in the meantime.
+                queue.popleft()
+                self.slots.release()
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.pending[key]
+                self.ready.task_done()
+
+    async def join(self):
+        """Wait until everything put on the pipeline has been processed."""
+        await self.ready.join()
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,61 @@
+import asyncio
+
+from time import monotonic
+
+import mxmda.metrics
+
+def rate_limited(resp):
+    # Some homeservers answer 429 without an M_LIMIT_EXCEEDED body.
+    return getattr(resp, 'status_code', None) in ('M_LIMIT_EXCEEDED', 429) \
+        or getattr(getattr(resp, 'transport_response', None),
+                   'status', None) == 429
+
+class RateLimiter:
+    """
+    Paces requests to the homeserver, shared by everything sending them.
+    When the server answers M_LIMIT_EXCEEDED, all requests are held back
+    for the retry_after_ms it asks for, and the requests that follow are
+    spaced out; the spacing doubles with every rate limited answer and
+    shrinks again as requests go through.
+
+    The client retries rate limited requests on its own; it reports each
+    rate limited answer through backoff(), see mxmda.matrix.Client.
+    """
+    def __init__(self, min_interval=0.05, max_interval=10, default_retry=1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_retry = default_retry
+        self.interval = 0
+        self.paused_until = 0
+        self.next_slot = 0
+        self.throttled = mxmda.metrics.counter('ratelimit.limited')
+
+    async def wait(self):
+        now = monotonic()
+        start = max(now, self.paused_until, self.next_slot)
+        self.next_slot = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def backoff(self, retry_after_ms=None):
+        self.throttled.inc()
+        retry = retry_after_ms / 1000 if retry_after_ms else self.default_retry
+        self.paused_until = max(self.paused_until, monotonic() + retry)
+        self.interval = min(self.max_interval,
+                            max(self.min_interval, self.interval * 2))
+
+    def recover(self):
+        self.interval *= 0.9
+        if self.interval < self.min_interval:
+            self.interval = 0
+
+    async def run(self, request):
+        """
+        Make a request, by calling request() for a coroutine, once it is
+        our turn. Returns the response.
+        """
+        await self.wait()
+        resp = await request()
+        if not rate_limited(resp):
+            self.recover()
+        return resp
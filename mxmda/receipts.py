@@ -0,0 +1,67 @@
+import asyncio
+
+from nio import UpdateReceiptMarkerResponse
+from nio.api import ReceiptType
+
+import mxmda.metrics
+
+class Receipts:
+    """
+    Coalesces read receipts. mark() only remembers the newest delivered
+    event per room; every interval seconds, one receipt per room is sent
+    for whatever was marked since the last flush. A receipt for an event
+    implies all earlier events, so nothing is lost by only sending the
+    newest one.
+    """
+    def __init__(self, app, interval=5):
+        self.app = app
+        self.interval = interval
+        self.latest = {}
+        self.task = None
+        self.sent = mxmda.metrics.counter('receipts.sent')
+        self.suppressed = mxmda.metrics.counter('receipts.suppressed')
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def mark(self, room, event):
+        if room.room_id in self.latest:
+            self.suppressed.inc()
+        self.latest[room.room_id] = event.event_id
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                # Receipts are merely nice to have; try again next time.
+                self.app.logger.exception("Failed to send read receipts")
+
+    async def flush(self):
+        latest, self.latest = self.latest, {}
+        await asyncio.gather(*[
+            self.send(room_id, event_id)
+            for room_id, event_id in latest.items()
+        ])
+
+    async def send(self, room_id, event_id):
+        marker = await self.app.client.update_receipt_marker(room_id,
+                                                             event_id,
+                                                             ReceiptType.read)
+        if not isinstance(marker, UpdateReceiptMarkerResponse):
+            self.app.logger.warning("Unable to update read marker for %s in %s",
+                                    event_id, room_id)
+            # Retry on the next flush, unless a newer event was marked
+            # in the meantime.
+            self.latest.setdefault(room_id, event_id)
+            return
+        self.sent.inc()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.latest:
+            await self.flush()
@@ -0,0 +1,120 @@
+import sqlite3
+
+from nio import MatrixRoom, RoomSummary
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    name TEXT,
+    canonical_alias TEXT,
+    topic TEXT,
+    encrypted INTEGER NOT NULL,
+    joined_count INTEGER,
+    invited_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS members (
+    room_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    display_name TEXT,
+    PRIMARY KEY (room_id, user_id)
+);
+"""
+
+class RoomCache:
+    """
+    Keeps the room state mxmda cares about (names, aliases, members) in
+    an sqlite database. nio's store only persists crypto state and the
+    sync token, so without this, every start would need a full state
+    sync just to know what the rooms are called.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def save(self, rooms, left=()):
+        """
+        Store the given MatrixRooms, replacing what was stored for them
+        before, and forget the rooms with ids in left.
+        """
+        with self.db as db:
+            for room in rooms:
+                summary = room.summary or RoomSummary()
+                db.execute(
+                    "INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (room.room_id, room.name, room.canonical_alias, room.topic,
+                     int(room.encrypted), summary.joined_member_count,
+                     summary.invited_member_count)
+                )
+                db.execute("DELETE FROM members WHERE room_id = ?",
+                           (room.room_id,))
+                db.executemany(
+                    "INSERT INTO members VALUES (?, ?, ?)",
+                    [(room.room_id, user.user_id, user.display_name)
+                     for user in room.users.values()]
+                )
+            for room_id in left:
+                db.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+                db.execute("DELETE FROM members WHERE room_id = ?", (room_id,))
+
+    def load(self, own_user_id):
+        """Return the stored rooms as a dict of room id to MatrixRoom."""
+        rooms = {}
+        for row in self.db.execute("SELECT * FROM rooms"):
+            room_id, name, alias, topic, encrypted, joined, invited = row
+            room = MatrixRoom(room_id, own_user_id, bool(encrypted))
+            room.name = name
+            room.canonical_alias = alias
+            room.topic = topic
+            room.summary = RoomSummary(invited, joined)
+            rooms[room_id] = room
+        for room_id, user_id, display_name in self.db.execute(
+            "SELECT room_id, user_id, display_name FROM members"
+        ):
+            if room_id in rooms:
+                rooms[room_id].add_member(user_id, display_name, None)
+        return rooms
+
+    def room_list(self, list_users=False):
+        """
+        Return the stored rooms in the shape of mxmda.control.room_info(),
+        straight from the database; building MatrixRooms for thousands of
+        rooms just to list them is slow.
+        """
+        users = {}
+        if list_users:
+            for room_id, user_id in self.db.execute(
+                "SELECT room_id, user_id FROM members"
+            ):
+                users.setdefault(room_id, []).append(user_id)
+
+        rooms = []
+        for room_id, name, alias, joined, invited, members in self.db.execute(
+            "SELECT room_id, name, canonical_alias, joined_count, "
+            "invited_count, (SELECT COUNT(*) FROM members "
+            "                WHERE members.room_id = rooms.room_id) "
+            "FROM rooms"
+        ):
+            room = {
+                'room_id': room_id,
+                'machine_name': alias or room_id,
+                'name': name,
+                # Like MatrixRoom.member_count
+                'member_count': members if joined is None or invited is None
+                                else joined + invited,
+            }
+            if list_users:
+                room['users'] = users.get(room_id, [])
+            rooms.append(room)
+        return rooms
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
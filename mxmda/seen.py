@@ -0,0 +1,183 @@
+import hashlib
+import math
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    event_id TEXT PRIMARY KEY,
+    ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS seen_ts ON seen (ts);
+CREATE TABLE IF NOT EXISTS filters (
+    day INTEGER PRIMARY KEY,
+    saved INTEGER NOT NULL,
+    bits BLOB NOT NULL
+);
+"""
+
+DAY = 86400
+
+def shape(capacity, error_rate):
+    """The number of bits and hashes of a Bloom filter."""
+    size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    return size, max(1, round(size / capacity * math.log(2)))
+
+def positions(key, size, hashes):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    a = int.from_bytes(digest[:8], 'little')
+    b = int.from_bytes(digest[8:], 'little') | 1
+    return [(a + i * b) % size for i in range(hashes)]
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01, bits=None):
+        self.size, self.hashes = shape(capacity, error_rate)
+        if bits is None or len(bits) != (self.size + 7) // 8:
+            bits = bytes((self.size + 7) // 8)
+        self.bits = bytearray(bits)
+
+    def positions(self, key):
+        return positions(key, self.size, self.hashes)
+
+    def add(self, positions):
+        for pos in positions:
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def contains(self, positions):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in positions)
+
+class SeenEvents:
+    """
+    Remembers the ids of delivered events in an sqlite database, so that
+    an event that comes around again (after a restart, a full state
+    sync, or a replay of the journal) isn't delivered twice.
+
+    Lookups go through in-memory Bloom filters first, so the common
+    case, an event that was never seen, is answered without touching the
+    database. There is one filter per day, each looked up in on its own;
+    a day's filter is dropped along with that day's ids once it is older
+    than max_age seconds. The filters are saved in the database, so
+    starting up doesn't mean reading every stored id.
+
+    Each day's filter is sized for capacity / days events, with an error
+    rate of error_rate / days, so that a lookup in all of them together
+    has about error_rate false positives at capacity. On busier days,
+    the database is consulted more often, but answers stay exact.
+    """
+    def __init__(self, path, max_age=30 * DAY, capacity=1000000,
+                 error_rate=0.01, save_every=1000):
+        self.path = path
+        self.max_age = max_age
+        # Up to one more day than max_age covers is live at a time.
+        days = max(1, max_age // DAY) + 1
+        self.day_capacity = max(1000, capacity // days)
+        self.day_error_rate = error_rate / days
+        self.size, self.hashes = shape(self.day_capacity, self.day_error_rate)
+        self.save_every = save_every
+        self.days = None
+        self.dirty = set()
+        self.unsaved = 0
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            # Losing the last few entries in a power failure only means
+            # a possible duplicate; not worth an fsync per event.
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def new_filter(self, bits=None):
+        return BloomFilter(self.day_capacity, self.day_error_rate, bits=bits)
+
+    def positions(self, event_id):
+        return positions(event_id, self.size, self.hashes)
+
+    def load(self):
+        self.days = {}
+        self.expire()
+        saved = {}
+        resized = False
+        for day, ts, bits in self.db.execute(
+            "SELECT day, saved, bits FROM filters"
+        ):
+            bloom = self.new_filter(bits)
+            if len(bits) != len(bloom.bits):
+                # Saved with another capacity; refilled from the ids below.
+                resized = True
+                continue
+            self.days[day] = bloom
+            saved[day] = ts
+        # Catch up on whatever was added after a filter was last saved.
+        for event_id, ts in self.db.execute(
+            "SELECT event_id, ts FROM seen WHERE ts >= ?",
+            (0 if resized else min(saved.values(), default=0),)
+        ):
+            day = ts // DAY
+            if ts >= saved.get(day, 0):
+                self.filter(day).add(self.positions(event_id))
+                self.dirty.add(day)
+
+    def filter(self, day):
+        if day not in self.days:
+            self.days[day] = self.new_filter()
+        return self.days[day]
+
+    def might_contain(self, event_id):
+        """Whether the filters say the event may have been seen."""
+        if self.days is None:
+            self.load()
+        positions = self.positions(event_id)
+        return any(bloom.contains(positions) for bloom in self.days.values())
+
+    def expire(self):
+        cutoff = int(time.time() - self.max_age)
+        with self.db as db:
+            db.execute("DELETE FROM seen WHERE ts < ?", (cutoff,))
+            db.execute("DELETE FROM filters WHERE day < ?", (cutoff // DAY,))
+        for day in [day for day in self.days if day < cutoff // DAY]:
+            del self.days[day]
+            self.dirty.discard(day)
+
+    def save(self):
+        now = int(time.time())
+        with self.db as db:
+            for day in self.dirty:
+                db.execute("INSERT OR REPLACE INTO filters VALUES (?, ?, ?)",
+                           (day, now, bytes(self.days[day].bits)))
+        self.dirty.clear()
+        self.unsaved = 0
+
+    def __contains__(self, event_id):
+        if not self.might_contain(event_id):
+            return False
+        return self.db.execute("SELECT 1 FROM seen WHERE event_id = ?",
+                               (event_id,)).fetchone() is not None
+
+    def add(self, event_id):
+        if self.days is None:
+            self.load()
+        now = int(time.time())
+        day = now // DAY
+        if day not in self.days:
+            # A new day; a good time to drop what has become too old.
+            self.expire()
+        self.filter(day).add(self.positions(event_id))
+        self.dirty.add(day)
+        with self.db as db:
+            db.execute("INSERT OR REPLACE INTO seen VALUES (?, ?)",
+                       (event_id, now))
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    def close(self):
+        if self._db is not None:
+            if self.dirty:
+                self.save()
+            self._db.close()
+            self._db = None
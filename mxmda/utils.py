@@ -1,3 +1,4 @@
+import fcntl
 import os
 import mxmda
 
@@ -5,6 +6,20 @@ def existing_dir(name):
     os.makedirs(name, exist_ok=True)
     return name
 
+def lock_file(name):
+    """
+    Take an exclusive lock on the file name, held until the returned file
+    is closed, or the process exits. Raises BlockingIOError if another
+    process holds it.
+    """
+    fh = open(name, 'a')
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BaseException:
+        fh.close()
+        raise
+    return fh
+
 class XDGPaths:
     def __init__(self, name=None):
         self.name = name or mxmda.__name__
@@ -0,0 +1,65 @@
+import json
+import logging
+
+import pytest
+
+import mxmda.matrix
+
+class FakeApp:
+    def __init__(self):
+        self.logger = logging.getLogger('mxmda.tests')
+        self.device = {}
+
+    def update_device(self, **items):
+        self.device.update(items)
+
+class FakeTransportResponse:
+    """Just enough of aiohttp's ClientResponse for nio to parse it."""
+    content_disposition = None
+    content_type = 'application/json'
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def json(self, **kwargs):
+        return self.body
+
+    async def text(self):
+        return json.dumps(self.body)
+
+    async def read(self):
+        return json.dumps(self.body).encode('utf-8')
+
+def rate_limited(retry_after_ms=10):
+    return FakeTransportResponse(429, {
+        'errcode': 'M_LIMIT_EXCEEDED',
+        'error': 'Too many requests',
+        'retry_after_ms': retry_after_ms,
+    })
+
+@pytest.fixture
+def client(tmp_path):
+    """
+    A logged in client whose send() answers from its .answers, a
+    function of the method and path, and records them in .requests.
+    """
+    app = FakeApp()
+    app.device.update(access_token='token', device_id='DEVICE',
+                      user_id='@mxmda:example.org')
+    client = mxmda.matrix.Client(
+        app=app,
+        config={'user': '@mxmda:example.org',
+                'homeserver': 'https://example.org'},
+        nio_dir=str(tmp_path / 'nio'),
+        device=app.device,
+    )
+    app.client = client
+    client.requests = []
+
+    async def send(method, path, *args, **kwargs):
+        client.requests.append((method, path))
+        return client.answers(method, path)
+
+    client.send = send
+    return client
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import logging
+from types import SimpleNamespace
+
+import mxmda.metrics
+from mxmda.acks import SyncAcks
+from mxmda.app import Service
+
+def test_token_waits_for_events_of_an_earlier_batch():
+    committed = []
+    acks = SyncAcks(committed.append)
+
+    # A sync response with a gap, held open while it is backfilled.
+    hold = acks.track()
+    acks.seal('gap')
+    event = acks.track()
+    acks.seal('next')
+    acks.done(event)
+
+    # Backfilled events are queued, and the hold released, while a
+    # later sync response is being handled.
+    backfilled = [acks.track(hold) for _ in range(2)]
+    acks.done(hold)
+    assert committed == []
+
+    acks.done(backfilled[0])
+    acks.done(backfilled[1])
+    assert committed == ['next']
+
+def test_cancelled_backfill_keeps_the_token():
+    committed = []
+    acks = SyncAcks(committed.append)
+
+    async def fetch_gap(room_id, start, end):
+        await asyncio.Event().wait()
+
+    async def main():
+        service = SimpleNamespace(
+            acks=acks, fetch_gap=fetch_gap,
+            backfills=asyncio.Semaphore(1),
+            gaps=mxmda.metrics.counter('backfill.gaps'),
+        )
+        hold = acks.track()
+        acks.seal('gap')
+        task = asyncio.ensure_future(Service.backfill(
+            service, '!room:example.org', 'prev', 'since', hold,
+        ))
+        await asyncio.sleep(0)
+        # Stopping mid-gap must not commit the token past the gap.
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(main())
+    assert committed == []
+
+def test_undeliverable_event_is_set_aside(tmp_path):
+    committed = []
+    acks = SyncAcks(committed.append)
+    attempts = []
+    room = SimpleNamespace(room_id='!room:example.org')
+    event = SimpleNamespace(event_id='$event', source={'event_id': '$event'})
+
+    async def handler(room, event):
+        attempts.append(event.event_id)
+        raise OSError("No space left on device")
+
+    service = SimpleNamespace(
+        acks=acks, journal=None, handler=handler,
+        delivery_attempts=3, delivery_retry=0.001,
+        dead_letters=str(tmp_path / 'deadletter.jsonl'),
+        undeliverable=mxmda.metrics.counter('events.undeliverable'),
+        logger=logging.getLogger('mxmda.tests'),
+    )
+    service.dead_letter = lambda *args: Service.dead_letter(service, *args)
+
+    ack = acks.track()
+    acks.seal('next')
+    asyncio.run(Service.process(service, room, event, ack))
+
+    # Retried, then logged and acknowledged; the token moves on.
+    assert attempts == ['$event'] * 3
+    assert committed == ['next']
+    with open(tmp_path / 'deadletter.jsonl') as fh:
+        assert [json.loads(line) for line in fh] == [{
+            'room_id': '!room:example.org',
+            'error': "No space left on device",
+            'event': {'event_id': '$event'},
+        }]
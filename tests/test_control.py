@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+import mxmda.control
+
+from mxmda.control import ControlServer
+from mxmda.errors import CommandError
+
+class FakeClient:
+    def __init__(self, members):
+        self.members = members
+
+    async def joined_member_ids(self, room_id):
+        return self.members
+
+class FakeApp:
+    def __init__(self, client):
+        self.client = client
+        self.logger = logging.getLogger('mxmda.tests')
+
+def call(tmp_path, client, *requests):
+    """Make requests to a control server, returning results or errors."""
+    async def run():
+        server = ControlServer(FakeApp(client), str(tmp_path / 'control.sock'))
+        await server.start()
+        connection = await mxmda.control.connect(server.path)
+        results = []
+        try:
+            for request in requests:
+                try:
+                    results.append(await mxmda.control.request(connection,
+                                                                **request))
+                except CommandError as exc:
+                    results.append(exc)
+        finally:
+            connection[1].close()
+            await server.close()
+        return results
+    return asyncio.run(run())
+
+def test_large_response(tmp_path):
+    members = ['@user%d:example.org' % n for n in range(20000)]
+    result, = call(tmp_path, FakeClient(members),
+                   {'command': 'members', 'room_id': '!room:example.org'})
+    assert result == members
+
+def test_bad_requests(tmp_path):
+    unknown, missing, extra = call(
+        tmp_path, FakeClient([]),
+        {'command': 'nonsense'},
+        {'command': 'members'},
+        {'command': 'members', 'room_id': '!room:example.org', 'x': 1},
+    )
+    assert str(unknown) == "Unknown command"
+    assert isinstance(missing, CommandError)
+    assert isinstance(extra, CommandError)
+
+def test_bugs_are_not_bad_requests(tmp_path, caplog):
+    class BrokenClient:
+        async def joined_member_ids(self, room_id):
+            raise AttributeError("oops")
+
+    error, = call(tmp_path, BrokenClient(),
+                  {'command': 'members', 'room_id': '!room:example.org'})
+    assert isinstance(error, CommandError)
+    assert "Control request failed" in caplog.text
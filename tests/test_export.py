@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from nio import MatrixRoom, RoomMessagesError, RoomMessagesResponse, \
+                RoomMessageText
+
+from mxmda.export import Checkpoint, Export
+from mxmda.ratelimit import RateLimiter
+
+from conftest import FakeApp
+
+def message(n):
+    return RoomMessageText.from_dict({
+        'type': 'm.room.message',
+        'event_id': '$%d' % n,
+        'sender': '@user:example.org',
+        'origin_server_ts': 1700000000000 + n,
+        'content': {'msgtype': 'm.text', 'body': 'Message %d' % n},
+    })
+
+class FakeClient:
+    """Serves endless history of 10 messages a page, or fails to."""
+    next_batch = 's0'
+
+    def __init__(self, rooms, failing=()):
+        self.rooms = {room_id: MatrixRoom(room_id, '@mxmda:example.org')
+                      for room_id in rooms}
+        self.failing = failing
+        self.limiter = RateLimiter()
+
+    async def room_messages(self, room_id, start, limit, message_filter):
+        if room_id in self.failing:
+            return RoomMessagesError('M_FORBIDDEN')
+        n = int(start[1:]) + 1
+        return RoomMessagesResponse(room_id, [message(n + i) for i in range(10)],
+                                    start, 's%d' % (n + 10))
+
+class FailingSink:
+    def position(self):
+        return None
+
+    def restore(self, position):
+        pass
+
+    def write(self, mails):
+        raise OSError(28, "No space left on device")
+
+def export(tmp_path, client, sink):
+    return Export(client, sink, Checkpoint(str(tmp_path / 'checkpoint')),
+                  list(client.rooms), concurrency=2, prefetch=2,
+                  logger=FakeApp().logger)
+
+def test_write_failure_ends_the_export(tmp_path):
+    client = FakeClient(['!a:example.org', '!b:example.org',
+                         '!c:example.org'])
+    with pytest.raises(OSError) as error:
+        asyncio.run(asyncio.wait_for(
+            export(tmp_path, client, FailingSink()).run(), 5
+        ))
+    # Not the TimeoutError of a hanging export.
+    assert error.value.errno == 28
+
+def test_fetch_failures_are_reported(tmp_path):
+    client = FakeClient(['!a:example.org'], failing=['!a:example.org'])
+    run = export(tmp_path, client, FailingSink())
+    assert asyncio.run(asyncio.wait_for(run.run(), 5)) == 0
+    assert run.failed == ['!a:example.org']
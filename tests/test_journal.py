@@ -0,0 +1,64 @@
+import os
+import threading
+
+from mxmda.journal import Journal
+
+def replay(path):
+    journal = Journal(path)
+    return journal, [source for _, _, source in journal.replay()]
+
+def test_acks_for_older_segments_are_kept(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal, events = replay(path)
+    a = journal.append('!room', {'event_id': '$a'})
+    journal.append('!room', {'event_id': '$c'})
+    journal.open(journal.segment + 1)
+    b = journal.append('!room', {'event_id': '$b'})
+    # Written to the second segment, which must outlive the first.
+    journal.ack(a)
+    journal.open(journal.segment + 1)
+    journal.ack(b)
+    journal.open(journal.segment + 1)
+    journal.close()
+
+    journal, events = replay(path)
+    assert events == [{'event_id': '$c'}]
+    journal.close()
+
+def test_acked_segments_are_removed(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal, _ = replay(path)
+    ids = []
+    for n in range(100):
+        ids.append(journal.append('!room', {'event_id': '$%d' % n}))
+        if n % 10 == 9:
+            journal.open(journal.segment + 1)
+    for record_id in ids[::-1]:
+        journal.ack(record_id)
+    journal.open(journal.segment + 1)
+    journal.close()
+
+    assert os.listdir(path) == [os.path.basename(journal.filename(
+        journal.segment
+    ))]
+    journal, events = replay(path)
+    assert events == []
+    journal.close()
+
+def test_rotation_stays_off_the_calling_thread(tmp_path, monkeypatch):
+    threads = []
+    for name in ('fsync', 'unlink'):
+        def record(*args, call=getattr(os, name)):
+            threads.append(threading.current_thread())
+            return call(*args)
+        monkeypatch.setattr(os, name, record)
+
+    journal, _ = replay(str(tmp_path / 'journal'))
+    journal.segment_size = 64
+    ids = [journal.append('!room', {'event_id': '$%d' % n}) for n in range(8)]
+    for record_id in ids:
+        journal.ack(record_id)
+    journal.close()
+
+    assert threads
+    assert threading.current_thread() not in threads
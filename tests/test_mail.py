@@ -0,0 +1,103 @@
+import os
+import random
+
+import pytest
+
+from nio import MatrixRoom, RoomMessageText
+
+from mxmda.mail import event_to_email, fast_event_to_email, flatten, \
+                       render_event
+
+GOLDEN = os.path.join(os.path.dirname(__file__), 'golden')
+
+def room(alias=None):
+    room = MatrixRoom('!room:example.org', '@mxmda:example.org')
+    room.canonical_alias = alias
+    return room
+
+def message(body, event_id='$event', sender='@user:example.org',
+            relates_to=None, **content):
+    content = dict(content, msgtype='m.text', body=body)
+    if relates_to:
+        content['m.relates_to'] = {'m.in_reply_to': {'event_id': relates_to},
+                                   'event_id': relates_to}
+    return RoomMessageText.from_dict({
+        'type': 'm.room.message',
+        'event_id': event_id,
+        'sender': sender,
+        'origin_server_ts': 1700000000123,
+        'content': content,
+    })
+
+# name: (room, event, source format, whether the fast path renders it)
+cases = {
+    'ascii': (room(), message("Hello, world"), 'json', True),
+    'utf8': (room('#rum:example.org'), message("Hallå, världen ✓"),
+             'json', True),
+    'reply': (room(), message("Right you are", relates_to='$earlier'),
+              'json', True),
+    'multiline': (room(), message("Subject line\n\nA body\nof lines\n"),
+                  'json', True),
+    'yaml': (room(), message("Hello, yaml"), 'yaml', True),
+    'long-subject': (room(), message("A subject line that is too long to "
+                                     "fit on one line of a mail header "
+                                     "without being folded"),
+                     'json', False),
+    'encoded-subject': (room(), message("=?utf-8?q?not_a_word?="),
+                        'json', False),
+}
+
+def fast(room, event, source_format, seed=0):
+    random.seed(seed)
+    return fast_event_to_email(room, event, source_format)
+
+def slow(room, event, source_format, seed=0):
+    # The email package picks its boundary the same way, from the same
+    # random numbers.
+    random.seed(seed)
+    return flatten(event_to_email(room, event, source_format))
+
+@pytest.mark.parametrize('name', sorted(cases))
+def test_golden(name):
+    room, event, source_format, fast_path = cases[name]
+    with open(os.path.join(GOLDEN, name + '.eml'), 'rb') as fh:
+        golden = fh.read()
+
+    assert slow(room, event, source_format) == golden
+    if fast_path:
+        assert fast(room, event, source_format) == golden
+    else:
+        assert fast(room, event, source_format) is None
+    random.seed(0)
+    mail = render_event(room, event, source_format)
+    assert (mail if isinstance(mail, bytes) else flatten(mail)) == golden
+
+def random_text(rng, alphabet, length):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+def test_fast_path_matches_email_package():
+    rng = random.Random(1995)
+    plain = 'abcdefghijklmnopqrstuvwxyz     ABC.,:;!?-_=+*"\'()<>@$%&/\n\n'
+    alphabets = [plain, plain + 'åäöé✓€😀', plain + '\t\r\x00\x1f\x7f']
+    rendered = 0
+    for n in range(3000):
+        body = random_text(rng, rng.choice(alphabets),
+                           rng.choice([0, 1, 5, 40, 80, 300]))
+        # Mostly plain ids, which the fast path handles, but not only.
+        event = message(
+            body,
+            event_id=rng.choice(['$event%d' % n] * 4 + ['$ev/%d+x=' % n,
+                                                        '$weird id %d' % n]),
+            sender=rng.choice(['@user:example.org'] * 4 +
+                              ['@odd user:example.org', '@ü:example.org']),
+            relates_to=rng.choice([None, '$earlier%d' % n]),
+        )
+        args = (room(rng.choice([None, '#room:example.org'])), event,
+                rng.choice(['json', 'yaml']))
+        mail = fast(*args, seed=n)
+        if mail is None:
+            continue
+        rendered += 1
+        assert mail == slow(*args, seed=n), body
+    # Or this would prove rather little.
+    assert rendered > 750
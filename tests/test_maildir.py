@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from mxmda.maildir import GroupCommit
+
+class FakeMaildir:
+    """Records the batches committed; commit() fails if told to."""
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def commit(self, names):
+        if self.error:
+            raise self.error
+        self.batches.append(names)
+        return ['cur/' + name for name in names]
+
+def test_batch_is_committed_after_the_window():
+    maildir = FakeMaildir()
+
+    async def run():
+        committer = GroupCommit(maildir, None, window=0.02, max_batch=64)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        futures = [committer.add(name) for name in ('a', 'b', 'c')]
+        assert await asyncio.gather(*futures) == ['cur/a', 'cur/b', 'cur/c']
+        return loop.time() - started
+
+    assert asyncio.run(run()) >= 0.02
+    assert maildir.batches == [['a', 'b', 'c']]
+
+def test_full_batch_is_committed_at_once():
+    maildir = FakeMaildir()
+
+    async def run():
+        committer = GroupCommit(maildir, None, window=10, max_batch=2)
+        futures = [committer.add(name) for name in ('a', 'b')]
+        return await asyncio.wait_for(asyncio.gather(*futures), 1)
+
+    assert asyncio.run(run()) == ['cur/a', 'cur/b']
+    assert maildir.batches == [['a', 'b']]
+
+def test_failed_commit_fails_the_whole_batch():
+    maildir = FakeMaildir(OSError(28, "No space left on device"))
+
+    async def run():
+        committer = GroupCommit(maildir, None, window=0.001)
+        futures = [committer.add(name) for name in ('a', 'b')]
+        for fut in futures:
+            with pytest.raises(OSError) as exc:
+                await fut
+            assert exc.value.errno == 28
+
+    asyncio.run(run())
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from mxmda.errors import CommandError
+from mxmda.matrix import STATE_TYPES, RoomMessageText
+
+from conftest import FakeTransportResponse, rate_limited
+
+def upload_filters(client):
+    filters = []
+
+    def answers(method, path):
+        filters.append(method)
+        return FakeTransportResponse(200, {'filter_id': 'f%d' % len(filters)})
+
+    client.answers = answers
+    return filters
+
+def test_commands_sync_state_changes(client):
+    types = client.sync_filter_definition()['room']['timeline']['types']
+    assert set(STATE_TYPES) <= set(types)
+
+def test_filters_are_uploaded_once(client):
+    uploads = upload_filters(client)
+
+    asyncio.run(client.setup_sync_filter())
+    command_filter = client.sync_filter
+    client.add_event_callback(lambda room, event: None, RoomMessageText)
+    asyncio.run(client.setup_sync_filter())
+    service_filter = client.sync_filter
+    assert len(uploads) == 2
+    assert command_filter != service_filter
+
+    asyncio.run(client.setup_sync_filter())
+    assert client.sync_filter == service_filter
+    client.event_callbacks.clear()
+    asyncio.run(client.setup_sync_filter())
+    assert client.sync_filter == command_filter
+    assert len(uploads) == 2
+
+def test_unfiltered_sync(client):
+    client.mxmda_config['sync_filter'] = False
+    uploads = upload_filters(client)
+    asyncio.run(client.setup_sync_filter())
+    assert client.sync_filter is None
+    assert uploads == []
+
+def test_stop_ends_a_long_poll(client):
+    closed = []
+
+    async def send(method, path, *args, **kwargs):
+        await asyncio.sleep(3600)
+
+    async def close():
+        closed.append(True)
+
+    client.send = send
+    client.close = close
+
+    async def run():
+        asyncio.get_running_loop().call_later(0.05, client.stop)
+        await asyncio.wait_for(client.enter_loop(), 5)
+
+    asyncio.run(run())
+    assert closed
+
+def test_joined_member_ids(client):
+    answers = [rate_limited(), FakeTransportResponse(200, {'joined': {
+        '@alice:example.org': {}, '@bob:example.org': {},
+    }})]
+    client.answers = lambda method, path: answers.pop(0)
+    headers = []
+    send = client.send
+
+    async def record_headers(method, path, *args, **kwargs):
+        headers.append(kwargs.get('headers'))
+        return await send(method, path)
+
+    client.send = record_headers
+    limited = client.limiter.throttled.value
+
+    members = asyncio.run(client.joined_member_ids('!room:example.org'))
+
+    assert members == ['@alice:example.org', '@bob:example.org']
+    assert client.limiter.throttled.value - limited == 1
+    assert headers == [{'Authorization': 'Bearer token'}] * 2
+    assert all('access_token' not in path for _, path in client.requests)
+
+class ErrorPage(FakeTransportResponse):
+    async def text(self):
+        return '<html>Bad Gateway</html>'
+
+def test_joined_member_ids_error_page(client):
+    client.answers = lambda method, path: ErrorPage(502, None)
+    with pytest.raises(CommandError, match='HTTP 502'):
+        asyncio.run(client.joined_member_ids('!room:example.org'))
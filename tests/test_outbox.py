@@ -0,0 +1,93 @@
+import asyncio
+import os
+
+from nio import MatrixRoom, RoomSendResponse
+
+from mxmda.mailindex import MailIndex
+from mxmda.outbox import Outbox
+from mxmda.ratelimit import RateLimiter
+
+from conftest import FakeApp
+
+ROOM = '!room:example.org'
+
+class FakeClient:
+    def __init__(self):
+        self.rooms = {ROOM: MatrixRoom(ROOM, '@mxmda:example.org')}
+        self.limiter = RateLimiter()
+        self.sent = []
+
+    async def room_send(self, room_id, message_type, content, tx_id=None):
+        self.sent.append(content['body'])
+        return RoomSendResponse('$%d' % len(self.sent), room_id)
+
+def drop(path, name, mail):
+    with open(os.path.join(path, 'new', name), 'wb') as fh:
+        fh.write(mail)
+
+def run_outbox(tmp_path, mails, expected):
+    """Drop mails in an outbox, and run it until it has handled them."""
+    path = str(tmp_path / 'outbox')
+    app = FakeApp()
+    app.client = FakeClient()
+    app.index = MailIndex(str(tmp_path / 'mailindex.db'))
+    outbox = Outbox(app, path, senders=1, poll_interval=0.01)
+    for name, mail in mails:
+        drop(path, name, mail)
+
+    async def run():
+        await outbox.start()
+        try:
+            for _ in range(500):
+                if len(os.listdir(os.path.join(path, 'cur'))) == expected:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await outbox.close()
+
+    return app, path, run
+
+def test_bad_mail_does_not_stop_the_outbox(tmp_path):
+    app, path, run = run_outbox(tmp_path, [
+        ('1.bad', b'To: room@example.org\n'
+                  b'Content-Type: text/plain; charset=x-unknown\n\n'
+                  b'Unreadable\n'),
+        ('2.good', b'To: room@example.org\n\nHello\n'),
+    ], expected=2)
+
+    asyncio.run(run())
+    assert app.client.sent == ['Hello']
+    assert sorted(os.listdir(os.path.join(path, 'cur'))) == \
+        ['1.bad:2,F', '2.good:2,S']
+
+def test_reply_to_the_sender_goes_to_the_room(tmp_path):
+    # Mail readers address replies to the From of the mail replied to,
+    # the sender of the event; the room comes from the index instead.
+    app, path, run = run_outbox(tmp_path, [
+        ('1.reply', b'To: alice@example.org\n'
+                    b'In-Reply-To: <$event@example.invalid>\n\n'
+                    b'Hi Alice\n'),
+    ], expected=1)
+    app.index.add('$event', '/maildir/cur/1.event:2,S', ROOM)
+    sent = []
+
+    async def room_send(room_id, message_type, content, tx_id=None):
+        sent.append((room_id, content))
+        return RoomSendResponse('$reply', room_id)
+
+    app.client.room_send = room_send
+    asyncio.run(run())
+    assert sent == [(ROOM, {
+        'msgtype': 'm.text',
+        'body': 'Hi Alice',
+        'm.relates_to': {'m.in_reply_to': {'event_id': '$event'}},
+    })]
+
+def test_room_in_cc_is_found(tmp_path):
+    app, path, run = run_outbox(tmp_path, [
+        ('1.group', b'To: alice@example.org\n'
+                    b'Cc: room@example.org\n\nHi all\n'),
+    ], expected=1)
+
+    asyncio.run(run())
+    assert app.client.sent == ['Hi all']
@@ -0,0 +1,91 @@
+import asyncio
+
+from mxmda.pipeline import Pipeline
+
+def test_keys_in_order_and_in_parallel():
+    running = {}
+    overlapped = set()
+    handled = []
+
+    async def handler(key, n):
+        assert not running.get(key), "%s handled twice at once" % key
+        running[key] = True
+        if any(running[other] for other in running if other != key):
+            overlapped.add(key)
+        await asyncio.sleep(0.001)
+        handled.append((key, n))
+        running[key] = False
+
+    async def run():
+        pipeline = Pipeline(handler, workers=4, key=lambda key, n: key)
+        pipeline.start()
+        for n in range(20):
+            for key in 'abc':
+                await pipeline.put(key, n)
+        await pipeline.join()
+        await pipeline.close()
+
+    asyncio.run(run())
+    assert len(handled) == 60
+    for key in 'abc':
+        assert [n for k, n in handled if k == key] == list(range(20))
+    assert overlapped
+
+def test_join_waits_for_everything():
+    handled = []
+
+    async def handler(n):
+        await asyncio.sleep(0.001 * (n % 3))
+        handled.append(n)
+
+    async def run():
+        pipeline = Pipeline(handler, workers=3)
+        pipeline.start()
+        for n in range(30):
+            await pipeline.put(n)
+        await pipeline.join()
+        assert sorted(handled) == list(range(30))
+        await pipeline.close()
+
+    asyncio.run(run())
+
+def test_put_waits_while_full():
+    async def run():
+        release = asyncio.Event()
+
+        async def handler(n):
+            await release.wait()
+
+        pipeline = Pipeline(handler, workers=1, depth=2)
+        pipeline.start()
+        await pipeline.put(1)
+        await pipeline.put(2)
+        put = asyncio.ensure_future(pipeline.put(3))
+        await asyncio.sleep(0.01)
+        assert not put.done()
+
+        release.set()
+        await asyncio.wait_for(put, 1)
+        await pipeline.join()
+        await pipeline.close()
+
+    asyncio.run(run())
+
+def test_failed_item_does_not_stop_its_key():
+    handled = []
+
+    async def handler(key, n):
+        if n == 0:
+            raise RuntimeError("boom")
+        handled.append(n)
+
+    async def run():
+        pipeline = Pipeline(handler, workers=2, key=lambda key, n: key)
+        pipeline.start()
+        for n in range(3):
+            await pipeline.put('a', n)
+        await pipeline.join()
+        await pipeline.close()
+
+    asyncio.run(run())
+    assert handled == [1, 2]
@@ -0,0 +1,64 @@
+import asyncio
+
+from nio import JoinResponse
+
+import mxmda.control
+
+from conftest import FakeTransportResponse, rate_limited
+
+def test_rate_limited_answers_reach_the_limiter(client):
+    answers = [rate_limited(), rate_limited(),
+               FakeTransportResponse(200, {'room_id': '!room:example.org'})]
+    client.answers = lambda method, path: answers.pop(0)
+    limited = client.limiter.throttled.value
+
+    resp = asyncio.run(client.limiter.run(
+        lambda: client.join('!room:example.org')
+    ))
+
+    assert isinstance(resp, JoinResponse)
+    assert len(client.requests) == 3
+    assert client.limiter.throttled.value - limited == 2
+    assert client.limiter.interval > 0
+
+def test_backoff_is_shared(client):
+    # The first join is rate limited; the joins that follow must wait
+    # out the retry_after_ms it asked for, instead of going ahead.
+    answers = [rate_limited(200)]
+    client.answers = lambda method, path: answers.pop(0) if answers else \
+        FakeTransportResponse(200, {'room_id': '!room:example.org'})
+    rooms = ['!%d:example.org' % n for n in range(8)]
+    started = []
+    send = client.send
+
+    async def slow_send(*args, **kwargs):
+        started.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.01)
+        return await send(*args, **kwargs)
+
+    client.send = slow_send
+    failed = asyncio.run(mxmda.control.join(client, rooms, concurrency=4))
+
+    assert failed == dict.fromkeys(rooms)
+    assert len(started) == 9
+    # Four joins went out before the server objected; none after it.
+    assert all(ts - started[0] >= 0.2 for ts in started[4:])
+
+def test_rate_limited_login_is_retried(client):
+    # Requests outside the limiter, like logging in, are still retried,
+    # and hold back everything else meanwhile.
+    answers = [rate_limited(), FakeTransportResponse(200, {
+        'user_id': '@mxmda:example.org',
+        'device_id': 'DEVICE',
+        'access_token': 'fresh',
+    })]
+    client.answers = lambda method, path: answers.pop(0)
+    client.mxmda_config['auth'] = {'type': 'm.login.password'}
+    client.mxmda.write_device = client.mxmda.device.update
+    limited = client.limiter.throttled.value
+
+    asyncio.run(client.login())
+
+    assert len(client.requests) == 2
+    assert client.limiter.throttled.value - limited == 1
+    assert client.mxmda.device['access_token'] == 'fresh'
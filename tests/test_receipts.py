@@ -0,0 +1,45 @@
+import asyncio
+
+from nio import MatrixRoom, RoomMessageText
+
+from mxmda.receipts import Receipts
+
+from conftest import FakeTransportResponse
+
+def message(n):
+    return RoomMessageText.from_dict({
+        'type': 'm.room.message',
+        'event_id': '$%d' % n,
+        'sender': '@user:example.org',
+        'origin_server_ts': 1700000000000,
+        'content': {'msgtype': 'm.text', 'body': 'Message %d' % n},
+    })
+
+def test_newest_event_per_room_is_sent(client):
+    client.answers = lambda method, path: FakeTransportResponse(200, {})
+    receipts = Receipts(client.mxmda)
+    rooms = [MatrixRoom('!%d:example.org' % n, '@mxmda:example.org')
+             for n in range(2)]
+    for n in range(3):
+        receipts.mark(rooms[0], message(n))
+    receipts.mark(rooms[1], message(3))
+
+    asyncio.run(receipts.flush())
+
+    paths = sorted(path for _, path in client.requests)
+    assert len(paths) == 2
+    assert '/receipt/m.read/$2' in paths[0].replace('%24', '$')
+    assert '/receipt/m.read/$3' in paths[1].replace('%24', '$')
+    assert receipts.latest == {}
+
+def test_failed_receipts_are_retried(client):
+    client.answers = lambda method, path: FakeTransportResponse(500, {
+        'errcode': 'M_UNKNOWN', 'error': 'Oops',
+    })
+    receipts = Receipts(client.mxmda)
+    room = MatrixRoom('!room:example.org', '@mxmda:example.org')
+    receipts.mark(room, message(1))
+
+    asyncio.run(receipts.flush())
+
+    assert receipts.latest == {room.room_id: '$1'}
@@ -0,0 +1,44 @@
+import time
+
+from mxmda.seen import DAY, SeenEvents
+
+def test_false_positives_at_capacity(tmp_path):
+    days = 30
+    capacity = 60000
+    seen = SeenEvents(str(tmp_path / 'seen.db'), max_age=days * DAY,
+                      capacity=capacity)
+    seen.load()
+    today = int(time.time()) // DAY
+    # Fill the filters as if capacity / days events had arrived on each
+    # day, without going through the database.
+    for n in range(capacity):
+        day = today - n % days
+        seen.filter(day).add(seen.positions('$seen%d' % n))
+
+    probes = 20000
+    false_positives = sum(seen.might_contain('$new%d' % n)
+                          for n in range(probes))
+    assert false_positives / probes < 0.02
+    seen.close()
+
+def test_seen_across_restarts(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    seen = SeenEvents(path)
+    seen.add('$delivered')
+    assert '$delivered' in seen
+    assert '$other' not in seen
+    seen.close()
+
+    seen = SeenEvents(path)
+    assert '$delivered' in seen
+    seen.close()
+
+def test_filters_saved_with_another_capacity(tmp_path):
+    path = str(tmp_path / 'seen.db')
+    seen = SeenEvents(path, capacity=10000)
+    seen.add('$delivered')
+    seen.close()
+
+    seen = SeenEvents(path, capacity=100000)
+    assert seen.might_contain('$delivered')
+    seen.close()
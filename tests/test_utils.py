@@ -0,0 +1,11 @@
+import pytest
+
+from mxmda.utils import lock_file
+
+def test_lock_file_is_exclusive(tmp_path):
+    name = str(tmp_path / 'lock')
+    held = lock_file(name)
+    with pytest.raises(BlockingIOError):
+        lock_file(name)
+    held.close()
+    lock_file(name).close()